@@ -17,6 +17,7 @@
 from __future__ import unicode_literals
 
 import mimetypes
+import os
 from itertools import chain
 
 import pytz
@@ -27,7 +28,64 @@ from indico.modules.attachments.models.legacy_mapping import LegacyAttachmentFol
 from indico.util.date_time import now_utc
 from indico.util.fs import secure_filename
 
-from indico_migrate.util import LocalFileImporterMixin, convert_to_unicode
+from indico_migrate.util import LocalFileImporterMixin, convert_to_unicode, find_local_file
+
+
+def has_special_protection(material, resource):
+    material_ac = material._Material__ac
+    resource_ac = resource._Resource__ac
+    # both inherit
+    if resource_ac._accessProtection == 0 and material_ac._accessProtection == 0:
+        return False
+    # resource is protected
+    if resource_ac._accessProtection > 0:
+        return True
+    # material is protected and resource inherits
+    if resource_ac._accessProtection == 0 and material_ac._accessProtection > 0:
+        return True
+    return False
+
+
+def iter_legacy_attachments(obj):
+    """Iterate over the materials of a legacy object and the resources to migrate from each of them"""
+    all_materials = chain(obj.materials.itervalues(), [getattr(obj, 'minutes', None)],
+                          [getattr(obj, 'slides', None)], [getattr(obj, 'paper', None)],
+                          [getattr(obj, 'poster', None)], [getattr(obj, 'video', None)])
+    all_materials = (m for m in all_materials if m is not None)
+    for material in all_materials:
+        # skip minutes with no special protection - they are migrated in the event_notes migration
+        resources = [resource for _, resource in material._Material__resources.iteritems() if
+                     not (material.id == 'minutes' and resource.id == 'minutes' and
+                          not has_special_protection(material, resource))]
+        if resources:
+            yield material, resources
+
+
+def get_skip_reason(resource, archive_dirs=(), symlinks=False):
+    """Get the reason why a legacy resource is not migrated to an attachment.
+
+    This applies the same checks as `AttachmentMixin._attachment_from_resource`
+    without creating anything.  Files are only looked up if `archive_dirs`
+    are given.
+
+    :param resource: A legacy resource (``Link`` or ``LocalFile``)
+    :param archive_dirs: The archive directories used by the migration
+    :param symlinks: Whether files with a non-UTF8 path are symlinked
+    :return: A short description of the reason or ``None``
+    """
+    if resource.__class__.__name__ == 'Link':
+        return 'missing URL' if not convert_to_unicode(resource.url).strip() else None
+    if not archive_dirs:
+        return None
+    archive_path, path = find_local_file(archive_dirs, resource)
+    if path is None or not os.path.exists(path):
+        return 'file not found'
+    if not symlinks:
+        try:
+            os.path.relpath(path, archive_path).decode('utf-8')
+        except UnicodeDecodeError:
+            return 'non-UTF8 path'
+    return None
 
 
 class AttachmentMixin(LocalFileImporterMixin):
@@ -138,29 +196,5 @@ class AttachmentMixin(LocalFileImporterMixin):
         self.protection_from_ac(attachment, resource._Resource__ac)
         return attachment
 
-    def _has_special_protection(self, material, resource):
-        material_ac = material._Material__ac
-        resource_ac = resource._Resource__ac
-        # both inherit
-        if resource_ac._accessProtection == 0 and material_ac._accessProtection == 0:
-            return False
-        # resource is protected
-        if resource_ac._accessProtection > 0:
-            return True
-        # material is protected and resource inherits
-        if resource_ac._accessProtection == 0 and material_ac._accessProtection > 0:
-            return True
-        return False
-
     def _iter_attachments(self, obj):
-        all_materials = chain(obj.materials.itervalues(), [getattr(obj, 'minutes', None)],
-                              [getattr(obj, 'slides', None)], [getattr(obj, 'paper', None)],
-                              [getattr(obj, 'poster', None)], [getattr(obj, 'video', None)])
-        all_materials = (m for m in all_materials if m is not None)
-        for material in all_materials:
-            # skip minutes with no special protection - they are migrated in the event_notes migration
-            resources = [resource for _, resource in material._Material__resources.iteritems() if
-                         not (material.id == 'minutes' and resource.id == 'minutes' and
-                              not self._has_special_protection(material, resource))]
-            if resources:
-                yield material, resources
+        return iter_legacy_attachments(obj)
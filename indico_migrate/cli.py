@@ -16,6 +16,7 @@
 
 from __future__ import print_function, unicode_literals
 
+import os
 import sys
 
 import click
@@ -61,6 +62,7 @@ def except_hook(exc_class, exception, tb):
 @click.option('--rb-zodb-uri', required=False, help="ZODB URI for the room booking database")
 @click.option('--photo-path', type=click.Path(exists=True, file_okay=False),
               help="path to the folder containing room photos")
+@click.option('--photo-jobs', type=int, default=8, help="Number of threads reading the room photos")
 @click.option('--reference-type', 'reference_types', multiple=True,
               help="Reference types ('report numbers'). Can be used multiple times to specify multiple reference types")
 @click.option('--default-currency', required=True, help="currency unit to use by default")
@@ -68,6 +70,47 @@ def except_hook(exc_class, exception, tb):
               help="Migrate broken events that have no category and would usually be skipped. "
                    "They will be added to a new 'Lost & Found' top-level category which needs to be checked "
                    "(and possibly deleted) manually.")
+@click.option('--parallel-steps', is_flag=True, default=False,
+              help="Run top-level steps which do not depend on each other concurrently")
+@click.option('--load-dir', type=click.Path(exists=True, file_okay=False),
+              help="Directory created by indico-migrate-extract. The users and room bookings are read from there "
+                   "instead of the ZODB; everything else still comes from the ZODB")
+@click.option('--dump-to', type=click.Path(file_okay=False),
+              help="Dump the migrated database to this (new) directory once the migration has finished. Use this "
+                   "when migrating into a scratch database, e.g. on a different server than the production one")
+@click.option('--dump-jobs', type=int, default=4, help="Number of tables to dump in parallel when using --dump-to")
+@click.option('--only-events', multiple=True,
+              help="Only migrate the event with the given legacy ID (and the bookings linked to it). Can be used "
+                   "multiple times. Users, categories and rooms are migrated as usual")
+@click.option('--only-category',
+              help="Only migrate the events in the subtree of the category with the given legacy ID (and the "
+                   "bookings linked to them). Users, categories and rooms are migrated as usual")
+@click.option('--delta-snapshot', type=click.File('w'),
+              help="Save a snapshot to the given file after a successful migration. It can be used with "
+                   "--delta-from to migrate only what changed in the meantime")
+@click.option('--delta-from', type=click.File('r'),
+              help="Only migrate the users, categories and events which are new or changed since the given "
+                   "snapshot was taken. The database must contain the data of the migration that created it")
+@click.option('--quarantine-file', type=click.Path(dir_okay=False, writable=True),
+              help="Migrate each event in a savepoint; events failing to migrate are rolled back and recorded in "
+                   "this file instead of aborting the migration")
+@click.option('--retry-quarantined', is_flag=True, default=False,
+              help="Only migrate the events recorded in the --quarantine-file. Requires --delta-from")
+@click.option('--fast-db', is_flag=True, default=False,
+              help="Tune the database connections for bulk loading (no synchronous commit, more memory)")
+@click.option('--fast-load', is_flag=True, default=False,
+              help="Drop secondary indexes and foreign keys of the events, attachments and room booking schemas "
+                   "during the migration and rebuild them afterwards")
+@click.option('--fast-load-jobs', type=int, default=4,
+              help="Number of indexes to rebuild in parallel when using --fast-load")
+@click.option('--booking-workers', type=int, default=0,
+              help="Migrate room bookings using this many worker processes")
+@click.option('--unicode-cache-size', type=int, default=50000,
+              help="Number of short legacy strings whose unicode version is cached (0 to disable)")
+@click.option('--sanitize-cache-size', type=int, default=10000,
+              help="Number of results kept by each of the cached string/email sanitizers")
+@click.option('--id-index-cache-size', type=int, default=1000,
+              help="Number of users/events/categories kept loaded by each index of the global namespace")
 @click.option('--debug', is_flag=True, default=False, help="Open debug shell if there is an error")
 @click.option('--no-gui', is_flag=True, default=False, help="Don't run the GUI")
 @click.option('--save-restore', type=click.File('w'), help="Save a restore point to the given file in case of failure")
@@ -82,6 +125,20 @@ def cli(sqlalchemy_uri, zodb_uri, rb_zodb_uri, verbose, dblog, debug, restore_fi
 
     from indico_migrate.importer import Importer
 
+    if kwargs['dump_to'] and os.path.exists(kwargs['dump_to']):
+        raise click.BadParameter('the dump directory must not exist yet', param_hint='--dump-to')
+
+    if restore_file and kwargs['delta_from']:
+        raise click.BadParameter('a delta migration cannot be restored', param_hint='--delta-from')
+
+    if kwargs['booking_workers'] > 1 and kwargs['parallel_steps']:
+        # forking while other steps' threads hold locks (logger, database pool, ZEO client) could
+        # leave the workers with locks that are never released
+        raise click.BadParameter('cannot be used with --parallel-steps', param_hint='--booking-workers')
+
+    if kwargs['retry_quarantined'] and not (kwargs['quarantine_file'] and kwargs['delta_from']):
+        raise click.BadParameter('--quarantine-file and --delta-from are required', param_hint='--retry-quarantined')
+
     if restore_file:
         debug = True
 
@@ -90,21 +147,25 @@ def cli(sqlalchemy_uri, zodb_uri, rb_zodb_uri, verbose, dblog, debug, restore_fi
 
     zodb_root = UnbreakingDB(get_storage(zodb_uri)).open().root()
 
+    if kwargs['only_category'] is not None and kwargs['only_category'] not in zodb_root['categories']:
+        raise click.BadParameter('no such category', param_hint='--only-category')
+
     Importer._global_ns = SharedNamespace('global_ns', zodb_root, {
         'user_favorite_categories': 'setdict',
+        'event_booking_ids': 'setdict',
         'room_mapping': dict,
         'venue_mapping': dict,
-        'legacy_event_ids': dict,
-        'legacy_category_ids': dict,
+        'legacy_event_ids': 'event_index',
+        'legacy_category_ids': 'category_index',
         'wf_registry': dict,
-        'used_short_urls': dict,
-        'legacy_survey_mapping': dict,
+        'used_short_urls': 'event_index',
+        'legacy_survey_mapping': 'survey_index',
         'ip_domains': dict,
-        'avatar_merged_user': dict,
+        'avatar_merged_user': 'user_index',
         'all_groups': dict,
-        'users_by_primary_email': dict,
-        'users_by_secondary_email': dict,
-        'users_by_email': dict,
+        'users_by_primary_email': 'user_index',
+        'users_by_secondary_email': 'user_index',
+        'users_by_email': 'user_index',
         'reference_types': dict,
         'lostandfound_category': lambda: None,
     })
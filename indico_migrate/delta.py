@@ -0,0 +1,314 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental ("delta") migrations.
+
+A full migration saves a snapshot containing the ZODB serial (the id of
+the transaction that last modified the object) of every avatar, category
+and conference together with the state of the global namespace.  A later
+run using that snapshot only migrates the objects whose serial changed
+and the ones that did not exist yet.
+
+Since most data of a conference lives in separate persistent objects
+(contributions, materials, registrants, ...) the snapshot also contains
+the id of the last transaction at the time it was taken.  The records
+modified by any later transaction are traced back to the avatar,
+category or conference they belong to, which is then migrated again.
+"""
+
+from __future__ import unicode_literals
+
+import re
+from collections import defaultdict
+
+import yaml
+from sqlalchemy import and_, bindparam, func, not_, select
+from ZODB.utils import p64, u64
+
+from indico.core.db import db
+from indico.modules.events.models.events import Event
+
+from indico_migrate.util import MigrationStateManager
+
+
+SERIAL_KINDS = ('avatars', 'categories', 'conferences')
+
+#: Rows in these schemas are only detached from deleted events instead
+#: of being deleted along with them
+DETACHED_SCHEMAS = frozenset({'users', 'categories', 'roombooking'})
+
+#: The legacy classes whose objects are tracked by their serial
+OWNER_CLASSES = {'Avatar': 'avatars', 'Category': 'categories', 'Conference': 'conferences'}
+
+#: Attributes referencing the object a legacy object belongs to, in the
+#: order in which they are followed (e.g. ``_conf`` or ``_Material__owner``)
+_OWNER_ATTRS = ('conference', 'conf', 'owner', 'parent', 'session', 'contribution', 'contrib', 'subContribution')
+_OWNER_ATTR_RE = re.compile(r'^(?:_[A-Za-z]\w*?__)?_?({})$'.format('|'.join(_OWNER_ATTRS)))
+
+
+def get_serial(storage, obj):
+    # loading the raw record gives us the serial without unpickling (or
+    # even activating) the object
+    return u64(storage.load(obj._p_oid, '')[1])
+
+
+def get_last_tid(zodb_root):
+    """Get the id of the last transaction committed to the storage of `zodb_root`"""
+    return u64(zodb_root._p_jar.db().storage.lastTransaction())
+
+
+def iter_categories(root):
+    stack = [root]
+    while stack:
+        categ = stack.pop()
+        yield categ
+        stack.extend(categ.subcategories.itervalues())
+
+
+def collect_serials(zodb_root):
+    """Get the serials of all objects relevant for a delta migration.
+
+    The id of the last committed transaction is included as ``tid``.
+    It is taken before the serials so a change committed while they are
+    collected is always found by `collect_changes` later.
+    """
+    storage = zodb_root._p_jar.db().storage
+    return {
+        'tid': get_last_tid(zodb_root),
+        'avatars': {key: get_serial(storage, obj) for key, obj in zodb_root['avatars'].iteritems()},
+        'conferences': {key: get_serial(storage, obj) for key, obj in zodb_root['conferences'].iteritems()},
+        'categories': {categ.id: get_serial(storage, categ)
+                       for categ in iter_categories(zodb_root['rootCategory'])}
+    }
+
+
+def _get_owner(obj, max_depth=20):
+    """Find the avatar, category or conference a legacy object belongs to.
+
+    :return: a ``(kind, key)`` tuple or ``None`` if the object cannot be
+             traced back to any of them
+    """
+    seen = set()
+    while obj is not None and id(obj) not in seen and len(seen) < max_depth:
+        seen.add(id(obj))
+        kind = OWNER_CLASSES.get(obj.__class__.__name__)
+        if kind is not None:
+            return kind, obj.id
+        if hasattr(obj, '_p_activate'):
+            obj._p_activate()
+        attrs = {}
+        for name, value in getattr(obj, '__dict__', {}).iteritems():
+            match = _OWNER_ATTR_RE.match(name)
+            if match and hasattr(value, '__dict__'):
+                attrs[match.group(1)] = value
+        obj = next((attrs[name] for name in _OWNER_ATTRS if name in attrs), None)
+    return None
+
+
+def collect_changes(zodb_root, tid):
+    """Find the objects modified by the transactions committed after `tid`.
+
+    Each record written by one of these transactions is traced back to
+    the avatar, category or conference it belongs to using the usual
+    back references of legacy objects.  Records without such a reference
+    (BTree buckets, persistent lists, ...) are attributed to the objects
+    found in the same transaction, since legacy Indico modified a single
+    event (or user, or category) per request.
+
+    :return: a ``(changes, unattributed)`` tuple where `changes` maps each
+             of the `SERIAL_KINDS` to the keys of the modified objects and
+             `unattributed` is the number of records that could not be
+             traced back to any object
+    """
+    conn = zodb_root._p_jar
+    storage = conn.db().storage
+    changes = {kind: set() for kind in SERIAL_KINDS}
+    unattributed = 0
+    for txn in storage.iterator(start=p64(tid + 1)):
+        owners = set()
+        unknown = 0
+        for record in txn:
+            if record.data is None:
+                # object deleted or creation undone
+                continue
+            owner = _get_owner(conn.get(record.oid))
+            if owner is None:
+                unknown += 1
+            else:
+                owners.add(owner)
+        if owners:
+            for kind, key in owners:
+                changes[kind].add(key)
+        else:
+            unattributed += unknown
+        conn.cacheGC()
+    return changes, unattributed
+
+
+def exclude_unmigrated_events(serials, event_subset, delta=None, old_serials=None):
+    """Update the serials of a run limited to some events before saving them.
+
+    The conferences outside the subset are left as they were, so the
+    snapshot must not claim they have been migrated: new ones are left
+    out so they are still new for the next delta run, changed ones get
+    a serial no conference can have, and deleted ones keep the serial
+    from the previous snapshot.
+
+    :param serials: The serials collected at the beginning of the run
+    :param event_subset: The ids of the conferences that were migrated
+    :param delta: The `DeltaState` of a delta run
+    :param old_serials: The serials from the snapshot used by a delta run
+    """
+    conferences = serials['conferences']
+    if delta is None:
+        for conf_id in conferences.viewkeys() - event_subset:
+            del conferences[conf_id]
+        return
+    for conf_id in delta.new['conferences'] - event_subset:
+        del conferences[conf_id]
+    for conf_id in delta.changed['conferences'] - event_subset:
+        conferences[conf_id] = 0
+    for conf_id in delta.deleted['conferences'] - event_subset:
+        conferences[conf_id] = old_serials['conferences'][conf_id]
+
+
+def save_snapshot(fd, serials):
+    """Save the data needed to run a delta migration later"""
+    yaml.dump({
+        'namespaces': MigrationStateManager.serialize_namespaces(),
+        'serials': serials
+    }, fd)
+
+
+class DeltaState(object):
+    """The objects that changed since a snapshot has been taken.
+
+    :param old_serials: The serials from the snapshot
+    :param new_serials: The current serials
+    """
+
+    def __init__(self, old_serials, new_serials):
+        self.new = {}
+        self.changed = {}
+        self.deleted = {}
+        self._unchanged = {}
+        for kind in SERIAL_KINDS:
+            old = old_serials[kind]
+            new = new_serials[kind]
+            self.new[kind] = new.viewkeys() - old.viewkeys()
+            self.deleted[kind] = old.viewkeys() - new.viewkeys()
+            self.changed[kind] = {key for key, serial in new.iteritems() if key in old and old[key] != serial}
+            self._unchanged[kind] = (old.viewkeys() & new.viewkeys()) - self.changed[kind]
+
+    def add_changes(self, changes):
+        """Mark objects as changed even though their own serial is the same
+
+        :param changes: the changes returned by `collect_changes`
+        """
+        for kind in SERIAL_KINDS:
+            self.changed[kind] |= changes[kind] & self._unchanged[kind]
+
+    def affected(self, kind):
+        """Get the ids of new and changed objects"""
+        return self.new[kind] | self.changed[kind]
+
+    def summary(self):
+        return ', '.join('{}: {} new, {} changed, {} deleted'.format(kind, len(self.new[kind]),
+                                                                    len(self.changed[kind]),
+                                                                    len(self.deleted[kind]))
+                         for kind in SERIAL_KINDS)
+
+
+class EventDataDeleter(object):
+    """Delete events and everything belonging to them.
+
+    Rows referencing the deleted rows are deleted as well, following the
+    foreign keys in the database schema.  Rows in one of the
+    `DETACHED_SCHEMAS` (e.g. room bookings linked to an event) are not
+    deleted but only detached; `restore_references` links them again once
+    the events have been re-created with the same ids.
+
+    Cycles of foreign keys are broken by setting the column of the foreign
+    key closing the cycle to NULL; if that column is not nullable, a
+    `RuntimeError` naming the tables of the cycle is raised.
+    """
+
+    def __init__(self):
+        self._references = defaultdict(list)
+        for table in db.metadata.sorted_tables:
+            for fk in table.foreign_keys:
+                self._references[fk.column.table].append(fk)
+        self._detached = []
+
+    def delete(self, event_ids):
+        table = Event.__table__
+        self._delete(table, table.c.id.in_(event_ids), [table])
+        # the old objects must not stay around in the session as new
+        # ones with the same primary key are going to be added
+        for key in list(db.session.identity_map.keys()):
+            if key[0] is Event and key[1][0] in event_ids:
+                db.session.expunge(db.session.identity_map[key])
+
+    def _delete(self, table, criterion, path):
+        for fk in self._references[table]:
+            child = fk.parent.table
+            child_criterion = fk.parent.in_(select([fk.column]).where(criterion).correlate(None))
+            if child is table:
+                # nullable references within the table are cleared first; non-nullable ones are fine as
+                # long as the referencing rows are deleted by the same statement
+                if fk.parent.nullable:
+                    db.session.execute(child.update().where(child_criterion).values({fk.parent.name: None}))
+                elif db.session.execute(select([func.count()]).select_from(table)
+                                        .where(and_(child_criterion, not_(criterion)))).scalar():
+                    raise RuntimeError('Rows of {} reference deleted rows of the same table through the non-nullable '
+                                       'column {}'.format(table.fullname, fk.parent.name))
+                continue
+            if child in path:
+                if not fk.parent.nullable:
+                    cycle = path[path.index(child):] + [child]
+                    raise RuntimeError('Cannot delete from tables whose foreign keys form a cycle without a nullable '
+                                       'column: {}'.format(' <- '.join(t.fullname for t in cycle)))
+                db.session.execute(child.update().where(child_criterion).values({fk.parent.name: None}))
+            elif child.schema in DETACHED_SCHEMAS and fk.parent.nullable:
+                self._detach(child, fk, child_criterion)
+            else:
+                self._delete(child, child_criterion, path + [child])
+        db.session.execute(table.delete().where(criterion))
+
+    def _detach(self, table, fk, criterion):
+        pk_cols = list(table.primary_key.columns)
+        rows = db.session.execute(select(pk_cols + [fk.parent]).where(criterion)).fetchall()
+        if not rows:
+            return
+        self._detached.append((table, fk, pk_cols, rows))
+        db.session.execute(table.update().where(criterion).values({fk.parent.name: None}))
+
+    def restore_references(self):
+        """Re-attach detached rows to the objects that exist again"""
+        restored = 0
+        for table, fk, pk_cols, rows in self._detached:
+            values = {row[-1] for row in rows}
+            existing = {x for x, in db.session.execute(select([fk.column]).where(fk.column.in_(values)))}
+            params = [dict({'_pk_{}'.format(col.name): row[i] for i, col in enumerate(pk_cols)}, _value=row[-1])
+                      for row in rows if row[-1] in existing]
+            if not params:
+                continue
+            pk_criterion = and_(*(col == bindparam('_pk_{}'.format(col.name)) for col in pk_cols))
+            db.session.execute(table.update().where(pk_criterion).values({fk.parent.name: bindparam('_value')}),
+                               params)
+            restored += len(params)
+        del self._detached[:]
+        return restored
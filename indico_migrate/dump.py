@@ -0,0 +1,71 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import subprocess
+import time
+
+from sqlalchemy.engine.url import make_url
+
+
+def _pg_connection_args(sqlalchemy_uri):
+    """Get the libpq command-line arguments and environment for a SQLAlchemy URI"""
+    url = make_url(sqlalchemy_uri)
+    args = []
+    env = dict(os.environ)
+    host = url.host or url.query.get('host')
+    if host:
+        args += ['--host', host]
+    if url.port:
+        args += ['--port', str(url.port)]
+    if url.username:
+        args += ['--username', url.username]
+    if url.password:
+        env[b'PGPASSWORD'] = url.password.encode('utf-8')
+    args += ['--dbname', url.database]
+    return args, env
+
+
+def dump_database(logger, sqlalchemy_uri, target_dir, jobs):
+    """Dump the migrated database so it can be restored on another server.
+
+    The dump uses the directory format of ``pg_dump``: the data of each
+    table is stored in its own ``COPY`` file and the sequences are set
+    to the values they have in the migrated database.  Both dumping and
+    restoring (``pg_restore --jobs``) can thus process several tables in
+    parallel.
+
+    :param logger: The migration logger
+    :param sqlalchemy_uri: The URI of the (scratch) database the migration
+                           has been performed on
+    :param target_dir: The directory to create the dump in; it must not
+                       exist yet
+    :param jobs: The number of tables to dump in parallel
+    """
+    args, env = _pg_connection_args(sqlalchemy_uri)
+    cmd = ['pg_dump', '--format=directory', '--jobs', str(jobs), '--no-owner', '--no-privileges',
+           '--file', target_dir] + args
+    logger.print_info('Dumping database to %[cyan]{}%[reset]...'.format(target_dir), always=True)
+    start = time.time()
+    proc = subprocess.Popen(map(bytes, cmd), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError('pg_dump failed ({}): {}'.format(proc.returncode, stderr.decode('utf-8', 'replace')))
+    logger.print_success('Database dumped in {:.02f} seconds'.format(time.time() - start), always=True)
+    logger.print_info('Restore it using %[yellow!]pg_restore --jobs {} --dbname <database> {}'
+                      .format(jobs, target_dir), always=True)
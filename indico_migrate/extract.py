@@ -0,0 +1,165 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+
+import json
+import os
+import time
+from multiprocessing import Pool, cpu_count
+
+import click
+
+from indico_migrate.records import MANIFEST_NAME, avatar_record, reservation_record, write_records
+from indico_migrate.util import UnbreakingDB, cformat2, get_storage, partition_keys
+
+
+click.disable_unicode_literals_warning = True
+
+
+class ExtractDomain(object):
+    """A set of legacy objects that can be extracted independently.
+
+    :param name: The name of the domain, used for the dump files
+    :param root_key: The key of the BTree in the ZODB root
+    :param make_record: A function converting a legacy object to a record
+    :param rb: Whether the data is in the room booking database
+    """
+
+    def __init__(self, name, root_key, make_record, rb=False):
+        self.name = name
+        self.root_key = root_key
+        self.make_record = make_record
+        self.rb = rb
+
+
+DOMAINS = {d.name: d for d in (
+    ExtractDomain('users', 'avatars', avatar_record),
+    ExtractDomain('bookings', 'Reservations', reservation_record, rb=True),
+)}
+
+
+def _open_root(zodb_uri):
+    return UnbreakingDB(get_storage(zodb_uri, read_only=True)).open().root()
+
+
+def _extract_partition(args):
+    zodb_uri, domain_name, part, min_key, max_key, target_dir = args
+    domain = DOMAINS[domain_name]
+    start = time.time()
+    root = _open_root(zodb_uri)
+    conn = root._p_jar
+
+    def _iter_records():
+        items = root[domain.root_key].itervalues(min=min_key, max=max_key)
+        for i, obj in enumerate(items, 1):
+            yield domain.make_record(obj)
+            if i % 5000 == 0:
+                conn.cacheMinimize()
+
+    filename = '{}.{:04d}.jsonl.gz'.format(domain.name, part)
+    count = write_records(os.path.join(target_dir, filename), _iter_records())
+    conn.db().close()
+    return domain.name, part, filename, count, time.time() - start
+
+
+def _load_manifest(target_dir):
+    try:
+        with open(os.path.join(target_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def _save_manifest(target_dir, manifest):
+    path = os.path.join(target_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def extract(zodb_uri, rb_zodb_uri, target_dir, domains, processes, partitions):
+    """Extract the given domains from the ZODB into `target_dir`.
+
+    Each domain is split into `partitions` key ranges which are
+    extracted in parallel by `processes` worker processes, each of
+    them using its own ZODB connection.  Domains that are extracted
+    again replace their previous data in the manifest while the data
+    of other domains is kept.
+    """
+    tasks = []
+    for domain in domains:
+        uri = rb_zodb_uri if domain.rb else zodb_uri
+        root = _open_root(uri)
+        ranges = partition_keys(root[domain.root_key], partitions)
+        root._p_jar.db().close()
+        tasks += [(uri, domain.name, i, min_key, max_key, target_dir)
+                  for i, (min_key, max_key) in enumerate(ranges)]
+        print(cformat2('%[cyan]{}%[reset]: {} partitions').format(domain.name, len(ranges)))
+
+    start = time.time()
+    results = {domain.name: [] for domain in domains}
+    pool = Pool(processes)
+    try:
+        for domain_name, part, filename, count, duration in pool.imap_unordered(_extract_partition, tasks):
+            results[domain_name].append({'part': part, 'file': filename, 'count': count, 'seconds': duration})
+            print(cformat2('%[green]\u2713%[reset] %[cyan]{}%[reset] #{}: {} records in {:.02f}s').format(
+                domain_name, part, count, duration))
+    finally:
+        pool.close()
+        pool.join()
+    total_duration = time.time() - start
+
+    manifest = _load_manifest(target_dir)
+    for domain_name, parts in results.iteritems():
+        parts.sort(key=lambda x: x['part'])
+        manifest[domain_name] = {'parts': parts, 'seconds': total_duration}
+        count = sum(p['count'] for p in parts)
+        print(cformat2('%[green!]{}%[reset]: {} records, {:.02f} records/s').format(
+            domain_name, count, count / max(sum(p['seconds'] for p in parts), 0.001)))
+    _save_manifest(target_dir, manifest)
+    print(cformat2('%[cyan]{:.06f} seconds%[reset]').format(total_duration))
+
+
+@click.command()
+@click.argument('zodb-uri')
+@click.argument('target-dir', type=click.Path(file_okay=False, writable=True))
+@click.option('--rb-zodb-uri', required=False, help="ZODB URI for the room booking database")
+@click.option('--domain', 'domain_names', multiple=True, type=click.Choice(sorted(DOMAINS)),
+              help="Only extract the given domain. Can be used multiple times; defaults to all domains")
+@click.option('--processes', '-j', type=int, default=cpu_count(), help="Number of worker processes")
+@click.option('--partitions', type=int, help="Number of partitions per domain (defaults to 4x the process count)")
+def cli(zodb_uri, target_dir, rb_zodb_uri, domain_names, processes, partitions):
+    """
+    This script extracts data from ZODB/Indico 1.2 into intermediate files.
+
+    Only the users and the room bookings can be extracted; categories and
+    events are always read from the ZODB by the migration. The resulting
+    directory can be passed to `indico-migrate --load-dir`, which will
+    then read the extracted domains from there instead of the ZODB.
+    """
+    domains = [DOMAINS[name] for name in (domain_names or sorted(DOMAINS))]
+    if not rb_zodb_uri:
+        if domain_names and any(d.rb for d in domains):
+            raise click.UsageError('--rb-zodb-uri is required to extract room booking data')
+        domains = [d for d in domains if not d.rb]
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    extract(zodb_uri, rb_zodb_uri, target_dir, domains, processes, partitions or processes * 4)
+
+
+def main():
+    return cli()
@@ -0,0 +1,159 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from indico.core.db import db
+
+
+#: The schemas receiving most of the data
+FAST_LOAD_SCHEMAS = ('events', 'attachments', 'roombooking')
+
+_INDEX_QUERY = '''
+    SELECT n.nspname, c.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = ANY(:schemas) AND
+          NOT i.indisprimary AND NOT i.indisunique AND NOT i.indisexclusion AND
+          NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)
+    ORDER BY n.nspname, c.relname
+'''
+
+_FOREIGN_KEY_QUERY = '''
+    SELECT n.nspname, c.relname, con.conname, pg_get_constraintdef(con.oid)
+    FROM pg_constraint con
+    JOIN pg_class c ON c.oid = con.conrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE con.contype = 'f' AND n.nspname = ANY(:schemas)
+    ORDER BY n.nspname, c.relname, con.conname
+'''
+
+_CONSTRAINT_TRIGGER_QUERY = '''
+    SELECT n.nspname, c.relname, t.tgname
+    FROM pg_trigger t
+    JOIN pg_class c ON c.oid = t.tgrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE NOT t.tgisinternal AND t.tgconstraint <> 0 AND t.tgenabled <> 'D' AND n.nspname = ANY(:schemas)
+    ORDER BY n.nspname, c.relname, t.tgname
+'''
+
+
+class FastLoader(object):
+    """Remove secondary indexes and constraints while loading data.
+
+    Maintaining indexes, foreign keys and constraint triggers row by row
+    is much slower than building/checking them once all the data is
+    there.  Primary keys, unique indexes and exclusion constraints are
+    kept since the migration relies on them.
+
+    :param logger: The migration logger
+    :param jobs: The number of indexes to build (or foreign keys to
+                 validate) in parallel
+    :param schemas: The schemas to process
+    """
+
+    def __init__(self, logger, jobs, schemas=FAST_LOAD_SCHEMAS):
+        self.logger = logger
+        self.jobs = jobs
+        self.schemas = list(schemas)
+        self.indexes = []
+        self.foreign_keys = []
+        self.triggers = []
+
+    def _quote(self, *names):
+        preparer = db.engine.dialect.identifier_preparer
+        return '.'.join(map(preparer.quote_identifier, names))
+
+    def _query(self, sql):
+        return db.session.execute(db.text(sql), {'schemas': self.schemas}).fetchall()
+
+    def disable(self):
+        """Drop the indexes and foreign keys and disable the constraint triggers"""
+        self.indexes = self._query(_INDEX_QUERY)
+        self.foreign_keys = self._query(_FOREIGN_KEY_QUERY)
+        self.triggers = self._query(_CONSTRAINT_TRIGGER_QUERY)
+        for schema, table, name, definition in self.foreign_keys:
+            db.session.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(self._quote(schema, table),
+                                                                          self._quote(name)))
+        for schema, name, definition in self.indexes:
+            db.session.execute('DROP INDEX {}'.format(self._quote(schema, name)))
+        for schema, table, name in self.triggers:
+            db.session.execute('ALTER TABLE {} DISABLE TRIGGER {}'.format(self._quote(schema, table),
+                                                                          self._quote(name)))
+        db.session.commit()
+        self.logger.print_info('Fast load: dropped %[cyan]{}%[reset] indexes and %[cyan]{}%[reset] foreign keys, '
+                               'disabled %[cyan]{}%[reset] constraint triggers'
+                               .format(len(self.indexes), len(self.foreign_keys), len(self.triggers)), always=True)
+
+    def _run_parallel(self, statements):
+        engine = db.engine
+
+        def _execute(sql):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(sql)
+            except Exception as exc:
+                return sql, exc
+            return sql, None
+
+        errors = []
+        pool = ThreadPool(self.jobs)
+        try:
+            for sql, exc in pool.imap_unordered(_execute, statements):
+                if exc is not None:
+                    errors.append((sql, exc))
+        finally:
+            pool.close()
+            pool.join()
+        return errors
+
+    def restore(self, validate=True):
+        """Rebuild what has been removed by `disable`.
+
+        The foreign keys are added back as ``NOT VALID``, so they are only
+        enforced for new rows, and then validated unless `validate` is
+        false (e.g. because the migration failed).
+
+        :return: ``True`` if everything has been restored successfully
+        """
+        start = time.time()
+        db.session.rollback()
+        for schema, table, name in self.triggers:
+            db.session.execute('ALTER TABLE {} ENABLE TRIGGER {}'.format(self._quote(schema, table),
+                                                                         self._quote(name)))
+        for schema, table, name, definition in self.foreign_keys:
+            db.session.execute('ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID'.format(self._quote(schema, table),
+                                                                                    self._quote(name), definition))
+        db.session.commit()
+        self.logger.print_info('Fast load: rebuilding %[cyan]{}%[reset] indexes...'.format(len(self.indexes)),
+                               always=True)
+        errors = self._run_parallel([definition for schema, name, definition in self.indexes])
+        if validate:
+            self.logger.print_info('Fast load: validating %[cyan]{}%[reset] foreign keys...'
+                                   .format(len(self.foreign_keys)), always=True)
+            errors += self._run_parallel(['ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(self._quote(schema, table),
+                                                                                         self._quote(name))
+                                          for schema, table, name, definition in self.foreign_keys])
+        for sql, exc in errors:
+            self.logger.print_error('%[red!]{}%[reset] failed: {}'.format(sql, exc), always=True)
+        if not errors:
+            self.logger.print_success('Fast load: indexes and constraints restored in {:.02f} seconds'
+                                      .format(time.time() - start), always=True)
+        return not errors
@@ -115,16 +115,25 @@ class GUILogger(BaseLogger):
 
     def progress_iterator(self, description, iterable, total, get_id, get_title, print_every=10):
         start_time = time.time()
-        progress_bar = self.gui.create_progress_bar(description)
+        with self.lock:
+            progress_bar = self.gui.create_progress_bar(description)
         for n, elem in enumerate(iterable, 1):
             if n % print_every == 0:
                 elapsed = time.time() - start_time  # seconds
                 eta = int((total - n) * elapsed / n)
-                progress_bar.set_state(n * 100 / total, get_id(elem)[:12], eta)
+                with self.lock:
+                    progress_bar.set_state(n * 100 / total, get_id(elem)[:12], eta)
             yield elem
-        progress_bar.remove()
+        with self.lock:
+            progress_bar.remove()
 
     def print_step(self, msg):
+        with self.lock:
+            self._print_step(msg)
+        # this is cheating, but makes the interface so much nicer!
+        time.sleep(0.25)
+
+    def _print_step(self, msg):
         contents = self.gui.steps.contents
         if contents:
             prev_msg = contents[-1][0].get_text()[0]
@@ -135,8 +144,6 @@ class GUILogger(BaseLogger):
 
         self.gui.set_step_banner(msg)
         self.gui.redraw()
-        # this is cheating, but makes the interface so much nicer!
-        time.sleep(0.25)
 
     def _print_msg(self, icon, msg, always=False, prefix='', event_id=''):
         if always or not self.quiet:
@@ -174,7 +181,9 @@ class StepProgressBar(object):
         self.gui.redraw()
 
     def remove(self):
-        self.gui.progress.remove(self.progress_widget)
+        # the bar may already be gone if a step running concurrently created a new one
+        if self.progress_widget in self.gui.progress:
+            self.gui.progress.remove(self.progress_widget)
         self.gui.redraw()
 
 
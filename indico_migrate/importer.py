@@ -17,16 +17,21 @@
 from __future__ import unicode_literals
 
 import time
+from collections import Counter
 from operator import itemgetter
 
+from sqlalchemy import event
 from sqlalchemy.sql import func, select
 
 from indico.core.db.sqlalchemy import db
 from indico.core.db.sqlalchemy.protection import ProtectionMode
 from indico.modules.groups import GroupProxy
+from indico.modules.users import User
 
 from indico_migrate.logger import logger_proxy
-from indico_migrate.util import convert_to_unicode
+from indico_migrate.namespaces import IdIndex
+from indico_migrate.records import DumpReader
+from indico_migrate.util import LRUCache, convert_to_unicode, get_identity
 
 
 class Importer(object):
@@ -41,6 +46,13 @@ class Importer(object):
     print_error = logger_proxy('error')
     print_log = logger_proxy('log')
 
+    #: Converted legacy principals shared by all importers, keyed by (class, id).
+    #: Users are stored as ``(user_id, None)`` and loaded again when needed
+    #: so the cache does not keep them (and all they have loaded) in memory.
+    _principal_cache = {}
+    _principal_cache_stats = Counter()
+    _serial_columns = None
+
     def __init__(self, logger, app, sqlalchemy_uri, zodb_root, verbose, dblog, default_group_provider, tz, **kwargs):
         self.sqlalchemy_uri = sqlalchemy_uri
         self.quiet = not verbose
@@ -83,8 +95,122 @@ class Importer(object):
             if i % n == 0:
                 conn.sync()
 
+    def commit_batch(self, table, rows, chunk_size=5000):
+        """Flush the session, insert the queued rows of `table` and commit.
+
+        Rows written using Core inserts usually reference objects added
+        through the ORM, so they can only be inserted after the flush.
+
+        :param table: the table the rows are inserted into
+        :param rows: a list of dicts; it is emptied once they are inserted
+        :param chunk_size: number of rows inserted by a single statement
+        """
+        db.session.flush()
+        for i in xrange(0, len(rows), chunk_size):
+            db.session.execute(table.insert().values(rows[i:i + chunk_size]))
+        del rows[:]
+        db.session.commit()
+
+    def batch_committing_iterator(self, iterable, table, rows, n):
+        """Iterates over `iterable` and calls `commit_batch` every `n` items and at the end.
+
+        :param iterable: an iterable object
+        :param table: the table of the rows queued while iterating
+        :param rows: the list the rows are queued in
+        :param n: number of items to commit after
+        """
+        for i, item in enumerate(iterable, 1):
+            yield item
+            if i % n == 0:
+                self.commit_batch(table, rows)
+        self.commit_batch(table, rows)
+
+    def adaptive_committing_iterator(self, iterable, max_pending=20000, max_seconds=10):
+        """Iterate over `iterable` and commit in batches of varying size.
+
+        A batch is committed once `max_pending` objects have been added
+        since the last commit (flushed or not) or `max_seconds` have passed
+        since the last commit.  After each commit, the objects created
+        during the batch are expunged from the session unless they are
+        referenced by the global namespace, so they can be garbage-collected.
+
+        The objects created while iterating are stored in the global
+        namespace as ids (see `IdIndex`) or directly in the namespace (e.g.
+        the lost & found category), so only the latter need to be checked
+        again after each commit.  The ``event_ns`` of an event is discarded
+        once the event has been migrated and items are only committed
+        between two events, so it does not reference any of the objects.
+
+        :param iterable: an iterable object
+        :param max_pending: number of new objects to commit after
+        :param max_seconds: number of seconds to commit after
+        """
+        session = db.session()
+        created = []
+        shared = set(self.global_ns.iter_objects())
+
+        def _after_flush(flushed_session, flush_context):
+            if flushed_session is session:
+                created.extend(flushed_session.new)
+
+        def _commit():
+            db.session.commit()
+            scalars = set(self.global_ns.iter_objects(dicts=False))
+            expunged = 0
+            for obj in created:
+                if obj not in shared and obj not in scalars and obj in session:
+                    session.expunge(obj)
+                    expunged += 1
+            del created[:]
+            self.print_log('%[cyan]Committed {} items; {} objects expunged, {} left in the session%[reset]'
+                           .format(count, expunged, len(session.identity_map)))
+            stats['batches'] += 1
+            stats['max_identity_map'] = max(stats['max_identity_map'], len(session.identity_map))
+
+        stats = Counter()
+        count = 0
+        last_commit = time.time()
+        event.listen(session, 'after_flush', _after_flush)
+        try:
+            for item in iterable:
+                yield item
+                count += 1
+                if len(created) + len(session.new) >= max_pending or time.time() - last_commit >= max_seconds:
+                    _commit()
+                    count = 0
+                    last_commit = time.time()
+            _commit()
+        finally:
+            event.remove(session, 'after_flush', _after_flush)
+        self.print_log('%[cyan]{} batches committed; identity map peaked at {} objects%[reset]'
+                       .format(stats['batches'], stats['max_identity_map']))
+
     def convert_principal(self, old_principal):
         """Converts a legacy principal to PrincipalMixin style"""
+        key = (old_principal.__class__.__name__, old_principal.id)
+        try:
+            user_id, principal = Importer._principal_cache[key]
+        except KeyError:
+            Importer._principal_cache_stats['misses'] += 1
+            principal = self._convert_principal(old_principal)
+            if isinstance(principal, User):
+                Importer._principal_cache[key] = (get_identity(principal), None)
+            else:
+                Importer._principal_cache[key] = (None, principal)
+        else:
+            Importer._principal_cache_stats['hits'] += 1
+            if user_id is not None:
+                # taken from the identity map unless it has been expunged
+                principal = User.get(user_id)
+            elif principal is None and key[0] == 'Avatar':
+                self.print_error("User {} doesn't exist".format(old_principal.id))
+        return principal
+
+    @classmethod
+    def clear_principal_cache(cls):
+        cls._principal_cache.clear()
+
+    def _convert_principal(self, old_principal):
         if old_principal.__class__.__name__ == 'Avatar':
             principal = self.global_ns.avatar_merged_user.get(old_principal.id)
             if not principal and 'email' in old_principal.__dict__:
@@ -106,24 +232,32 @@ class Importer(object):
         """Convert ACL principals to new objects"""
         return set(filter(None, (self.convert_principal(principal) for principal in opt._PluginOption__value)))
 
+    @classmethod
+    def _get_serial_columns(cls):
+        """Get the ``(schema, table name, serial column, sequence name)`` of all tables with a serial column"""
+        if cls._serial_columns is None:
+            serial_columns = []
+            for name, model in sorted(db.Model._decl_class_registry.iteritems(), key=itemgetter(0)):
+                table = getattr(model, '__table__', None)
+                if table is None:
+                    continue
+                # Check if we have a single autoincrementing primary key
+                candidates = [col for col in table.c if col.autoincrement and col.primary_key]
+                if len(candidates) != 1 or not isinstance(candidates[0].type, db.Integer):
+                    continue
+                serial_col = candidates[0]
+                sequence_name = '{}.{}_{}_seq'.format(table.schema, model.__tablename__, serial_col.name)
+                serial_columns.append((table.schema, model.__tablename__, serial_col, sequence_name))
+            Importer._serial_columns = serial_columns
+        return cls._serial_columns
+
     def fix_sequences(self, schema=None, tables=None):
-        for name, cls in sorted(db.Model._decl_class_registry.iteritems(), key=itemgetter(0)):
-            table = getattr(cls, '__table__', None)
-            if table is None:
-                continue
-            elif schema is not None and table.schema != schema:
-                continue
-            elif tables is not None and cls.__tablename__ not in tables:
-                continue
-            # Check if we have a single autoincrementing primary key
-            candidates = [col for col in table.c if col.autoincrement and col.primary_key]
-            if len(candidates) != 1 or not isinstance(candidates[0].type, db.Integer):
-                continue
-            serial_col = candidates[0]
-            sequence_name = '{}.{}_{}_seq'.format(table.schema, cls.__tablename__, serial_col.name)
-
-            query = select([func.setval(sequence_name, func.max(serial_col) + 1)], table)
-            db.session.execute(query)
+        setvals = [func.setval(sequence_name, select([func.max(serial_col) + 1]).as_scalar())
+                   for table_schema, table_name, serial_col, sequence_name in self._get_serial_columns()
+                   if (schema is None or table_schema == schema) and (tables is None or table_name in tables)]
+        # all sequences are updated by a single statement
+        if setvals:
+            db.session.execute(select(setvals))
         db.session.commit()
 
     def protection_from_ac(self, target, ac, acl_attr='acl', ac_attr='allowed', allow_public=False):
@@ -154,14 +288,64 @@ class Importer(object):
 
 
 class TopLevelMigrationStep(Importer):
+    #: The domain of an ``indico-migrate-extract`` dump the step can read its data from
+    extract_domain = None
+    #: Whether the step can migrate only the changes since a snapshot
+    supports_delta = False
+    #: The global namespace entries and tables (``schema.table``) the step needs
+    requires = frozenset()
+    #: The global namespace entries and tables (``schema.table``) the step fills
+    provides = frozenset()
+    #: Whether the step only exchanges data with other steps through the
+    #: database, so it can run in its own thread (and thus session)
+    isolated = False
+
+    def __init__(self, *args, **kwargs):
+        super(TopLevelMigrationStep, self).__init__(*args, **kwargs)
+        self.delta = kwargs.get('delta')
+        self.event_subset = kwargs.get('event_subset')
+        load_dir = kwargs.get('load_dir')
+        self.dump = None
+        if self.extract_domain and load_dir:
+            dump = DumpReader(load_dir)
+            if dump.has_domain(self.extract_domain):
+                self.dump = dump
+
+    def iter_records(self, tree, make_record):
+        """Iterate over the records of the step's data.
+
+        If the step's domain is available in the dump passed via
+        ``--load-dir``, the records are read from there.  Otherwise they
+        are created from the legacy objects in the given BTree.
+
+        :return: a ``(records, total)`` tuple
+        """
+        if self.dump is not None:
+            self.print_info('Loading %[cyan]{}%[reset] from dump'.format(self.extract_domain), always=True)
+            return self.dump.iter_records(self.extract_domain), self.dump.count(self.extract_domain)
+        return (make_record(obj) for obj in tree.itervalues()), len(tree)
+
     def run(self):
         start = time.time()
+        stats = Counter(Importer._principal_cache_stats)
+        caches = [('{} cache'.format(cache.__name__), cache) for cache in LRUCache.instances]
+        caches += [('{} index'.format(index.name), index) for index in IdIndex.instances]
+        cache_stats = [(name, cache, cache.hits, cache.misses) for name, cache in caches]
         self.pre_migrate()
         try:
             self.migrate()
         finally:
             self.post_migrate()
         self.print_log('%[cyan]{:.06f} seconds%[reset]\a'.format((time.time() - start)))
+        stats = Importer._principal_cache_stats - stats
+        if stats:
+            self.print_log('%[cyan]Principal cache: {} hits, {} misses%[reset]'.format(stats['hits'], stats['misses']))
+        for name, cache, hits, misses in cache_stats:
+            hits = cache.hits - hits
+            misses = cache.misses - misses
+            if hits or misses:
+                self.print_log('%[cyan]{}: {} hits, {} misses ({:.01%} overall)%[reset]'
+                               .format(name, hits, misses, cache.hit_rate))
 
     def pre_migrate(self):
         pass
@@ -21,6 +21,7 @@ import re
 import shutil
 import sys
 from io import BytesIO
+from threading import RLock
 
 from indico.util.console import clear_line, verbose_iterator
 
@@ -44,6 +45,8 @@ class BaseLogger(object):
     def __init__(self, quiet):
         self.quiet = quiet
         self.buffer = BytesIO()
+        # steps may run in several threads
+        self.lock = RLock()
 
     def shutdown(self):
         pass
@@ -81,9 +84,10 @@ class BaseLogger(object):
 
     def print_msg(self, icon, msg, always=False, prefix='', event_id=''):
         """Write the message to both the screen and the internal buffer."""
-        if always or not self.quiet:
-            self._print_to_buffer(icon, msg, always, prefix, event_id)
-        self._print_msg(icon, msg, always=always, prefix=prefix, event_id=event_id)
+        with self.lock:
+            if always or not self.quiet:
+                self._print_to_buffer(icon, msg, always, prefix, event_id)
+            self._print_msg(icon, msg, always=always, prefix=prefix, event_id=event_id)
 
     def _print_msg(self, icon, msg, always=False, prefix='', event_id=''):
         raise NotImplemented
@@ -97,6 +101,26 @@ class BaseLogger(object):
         self.buffer.write(strip_cformat(icon + ' ' + prefix + msg + suffix + '\n').encode('utf-8'))
 
 
+class WorkerLogger(BaseLogger):
+    """Send the messages of a worker process to the main process.
+
+    The messages are put into `queue` as they are logged and printed by
+    the main process using the actual logger, so they do not pile up in
+    the worker.
+
+    :param quiet: Whether only messages logged with ``always=True`` are sent
+    :param queue: A `multiprocessing.Queue` read by the main process
+    """
+
+    def __init__(self, quiet, queue):
+        super(WorkerLogger, self).__init__(quiet)
+        self.queue = queue
+
+    def print_msg(self, icon, msg, always=False, prefix='', event_id=''):
+        if always or not self.quiet:
+            self.queue.put((icon, msg, always, prefix, event_id))
+
+
 class StdoutLogger(BaseLogger):
     def _print_msg(self, icon, msg, always=False, prefix='', event_id=''):
         """Prints a message to the console.
@@ -24,6 +24,7 @@ from logging.handlers import SocketHandler
 import pytz
 import yaml
 from flask.helpers import get_root_path
+from sqlalchemy import event
 from sqlalchemy.orm import configure_mappers
 
 from indico.core.db.sqlalchemy import db
@@ -38,8 +39,42 @@ from indico.modules.oauth.models.applications import SystemAppType, OAuthApplica
 from indico.util.console import cformat
 from indico.web.flask.wrappers import IndicoFlask
 
+from indico_migrate.delta import (DeltaState, collect_changes, collect_serials, exclude_unmigrated_events,
+                                  save_snapshot)
+from indico_migrate.dump import dump_database
+from indico_migrate.fastload import FastLoader
+from indico_migrate.namespaces import set_id_index_cache_size
 from indico_migrate.paste import ask_to_paste, get_full_stack
-from indico_migrate.util import MigrationStateManager, UnbreakingDB, get_storage
+from indico_migrate.quarantine import load_quarantined_ids
+from indico_migrate.scheduler import StepScheduler
+from indico_migrate.util import (MigrationStateManager, UnbreakingDB, get_event_subset, get_storage,
+                                 set_sanitize_cache_size, set_unicode_cache_size)
+
+
+#: PostgreSQL settings used for all connections with ``--fast-db``
+FAST_DB_SETTINGS = {
+    # a crash of the database server may lose the last few commits, but the
+    # migration would have to be restarted from scratch in that case anyway
+    'synchronous_commit': 'off',
+    'work_mem': '64MB',
+    'maintenance_work_mem': '1GB'
+}
+
+
+def _apply_fast_db_settings(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    for name, value in sorted(FAST_DB_SETTINGS.iteritems()):
+        cursor.execute('SET {} = %s'.format(name), (value,))
+    cursor.close()
+    # settings changed in a transaction which is rolled back are reverted
+    dbapi_conn.commit()
+
+
+def _describe_db_profile(fast_db):
+    if not fast_db:
+        return 'default'
+    return 'fast ({})'.format(', '.join('{}={}'.format(name, value)
+                                        for name, value in sorted(FAST_DB_SETTINGS.iteritems())))
 
 
 def _monkeypatch_config():
@@ -71,40 +106,140 @@ def migrate(logger, zodb_root, zodb_rb_uri, sqlalchemy_uri, verbose=False, dblog
     steps = (GlobalPreEventsImporter, UserImporter, RoomsLocationsImporter, CategoryImporter, EventImporter,
              RoomBookingsImporter, GlobalPostEventsImporter, EventSeriesImporter, GlobalBadgePosterImporter)
 
-    app, tz = setup(logger, zodb_root, sqlalchemy_uri, dblog=dblog, restore=(restore_file is not None))
+    delta_from = kwargs.pop('delta_from')
+    fast_db = kwargs.pop('fast_db')
+    app, tz = setup(logger, zodb_root, sqlalchemy_uri, dblog=dblog,
+                    restore=(restore_file is not None or delta_from is not None), fast_db=fast_db)
 
     default_group_provider = kwargs.pop('default_group_provider')
     save_restore = kwargs.pop('save_restore')
+    dump_to = kwargs.pop('dump_to')
+    dump_jobs = kwargs.pop('dump_jobs')
+    delta_snapshot = kwargs.pop('delta_snapshot')
+    only_events = kwargs.pop('only_events')
+    only_category = kwargs.pop('only_category')
+    parallel_steps = kwargs.pop('parallel_steps')
+    fast_load = kwargs.pop('fast_load')
+    fast_load_jobs = kwargs.pop('fast_load_jobs')
+    retry_quarantined = kwargs.pop('retry_quarantined')
+    quarantine_file = kwargs.get('quarantine_file')
+    set_unicode_cache_size(kwargs.pop('unicode_cache_size'))
+    set_sanitize_cache_size(kwargs.pop('sanitize_cache_size'))
+    set_id_index_cache_size(kwargs.pop('id_index_cache_size'))
     debug = kwargs.get('debug', False)
 
     with app.app_context():
         try:
+            if delta_snapshot or delta_from:
+                # collect the serials first; anything modified while the migration
+                # is running will then be migrated again by the next delta run
+                logger.print_info('Collecting ZODB serials...', always=True)
+                serials = collect_serials(zodb_root)
+
             if restore_file:
                 logger.print_info('loading restore file %[cyan!]{}'.format(restore_file.name), always=True)
                 import time
                 time.sleep(1)
-                # preload some data, so that we don't have to
-                # retrieve it from the DB later
-                all_users = db.m.User.query.all()
-                all_categories = db.m.Category.query.all()
-                logger.print_info('{} users, {} categories preloaded'.format(len(all_users), len(all_categories)),
-                                  always=True)
+                _preload_data(logger)
                 data = yaml.load(restore_file, Loader=_zodb_powered_loader(zodb_root))
                 MigrationStateManager.load_restore_point(data)
+            elif delta_from:
+                logger.print_info('loading delta snapshot %[cyan!]{}'.format(delta_from.name), always=True)
+                _preload_data(logger)
+                data = yaml.load(delta_from, Loader=_zodb_powered_loader(zodb_root))
+                MigrationStateManager.load_namespaces(data)
+                kwargs['delta'] = DeltaState(data['serials'], serials)
+                if 'tid' in data['serials']:
+                    logger.print_info('Tracing ZODB changes...', always=True)
+                    changes, unattributed = collect_changes(zodb_root, data['serials']['tid'])
+                    kwargs['delta'].add_changes(changes)
+                    if unattributed:
+                        logger.print_warning('%[yellow!]{} modified ZODB records could not be traced back to a user, '
+                                             'category or event; the changes they contain are not migrated'
+                                             .format(unattributed), always=True)
+                else:
+                    logger.print_warning('%[yellow!]The snapshot contains no transaction id; only changes to '
+                                         'users, categories and events themselves are detected, not to the objects '
+                                         'belonging to them', always=True)
+                logger.print_info(kwargs['delta'].summary(), always=True)
+
+            if only_events or only_category is not None:
+                kwargs['event_subset'] = get_event_subset(zodb_root, only_events, only_category)
+                logger.print_info('Migrating only %[cyan!]{}%[reset] events'.format(len(kwargs['event_subset'])),
+                                  always=True)
 
-            for step in steps:
-                if MigrationStateManager.has_already_run(step):
-                    logger.print_info('Skipping previously-run step {}...'.format(step.__name__), always=True)
-                    continue
+            if retry_quarantined:
+                quarantined = load_quarantined_ids(quarantine_file)
+                if kwargs.get('event_subset') is not None:
+                    quarantined &= kwargs['event_subset']
+                kwargs['event_subset'] = frozenset(quarantined)
+                # in case the snapshot has been saved by a run that did not quarantine them
+                kwargs['delta'].new['conferences'] |= quarantined & serials['conferences'].viewkeys()
+                logger.print_info('Retrying %[cyan!]{}%[reset] quarantined events'.format(len(quarantined)),
+                                  always=True)
+
+            def _run_step(step, step_zodb_root):
                 if step in (RoomsLocationsImporter, RoomBookingsImporter):
                     if zodb_rb_uri:
                         zodb_rb_root = UnbreakingDB(get_storage(zodb_rb_uri)).open().root()
-                        step(logger, app, sqlalchemy_uri, zodb_root, verbose, dblog, default_group_provider, tz,
-                             rb_root=zodb_rb_root, **kwargs).run()
+                        step(logger, app, sqlalchemy_uri, step_zodb_root, verbose, dblog, default_group_provider,
+                             tz, rb_root=zodb_rb_root, rb_zodb_uri=zodb_rb_uri, **kwargs).run()
                 else:
-                    step(logger, app, sqlalchemy_uri, zodb_root, verbose, dblog, default_group_provider, tz,
+                    step(logger, app, sqlalchemy_uri, step_zodb_root, verbose, dblog, default_group_provider, tz,
                          **kwargs).run()
                 MigrationStateManager.register_step(step)
+
+            steps_to_run = []
+            available = set()
+            for step in steps:
+                if MigrationStateManager.has_already_run(step):
+                    logger.print_info('Skipping previously-run step {}...'.format(step.__name__), always=True)
+                    available |= step.provides
+                elif delta_from and not step.supports_delta:
+                    logger.print_warning('%[yellow]Skipping step {} (not supported in delta mode)'
+                                         .format(step.__name__), always=True)
+                    available |= step.provides
+                else:
+                    steps_to_run.append(step)
+
+            fast_loader = None
+            if fast_load:
+                fast_loader = FastLoader(logger, fast_load_jobs)
+                fast_loader.disable()
+            try:
+                if parallel_steps:
+                    StepScheduler(logger, app, zodb_root, steps_to_run, _run_step, available).run()
+                else:
+                    for step in steps_to_run:
+                        _run_step(step, zodb_root)
+            except Exception:
+                if fast_loader is not None:
+                    exc_info = sys.exc_info()
+                    # a restored migration needs the indexes and constraints to be back
+                    try:
+                        fast_loader.restore(validate=False)
+                    except Exception as restore_exc:
+                        logger.print_error('%[red!]Restoring the indexes and constraints failed as well: {}'
+                                           .format(restore_exc), always=True)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                raise
+            if fast_loader is not None and not fast_loader.restore():
+                # neither a snapshot nor a dump must be created from a database in this state
+                raise RuntimeError('Some indexes or constraints could not be restored')
+            if delta_snapshot:
+                if kwargs.get('event_subset') is not None:
+                    delta = kwargs.get('delta')
+                    exclude_unmigrated_events(serials, kwargs['event_subset'], delta,
+                                              data['serials'] if delta is not None else None)
+                if quarantine_file:
+                    # quarantined events need to be migrated again by the next delta run
+                    for conf_id in load_quarantined_ids(quarantine_file):
+                        serials['conferences'].pop(conf_id, None)
+                logger.print_info('Saving delta snapshot...', always=True)
+                save_snapshot(delta_snapshot, serials)
+            if dump_to:
+                dump_database(logger, sqlalchemy_uri, dump_to, dump_jobs)
+            logger.print_info('Database profile: %[cyan]{}'.format(_describe_db_profile(fast_db)), always=True)
             logger.set_success()
             logger.shutdown()
         except Exception as exc:
@@ -130,6 +265,14 @@ def migrate(logger, zodb_root, zodb_rb_uri, sqlalchemy_uri, verbose=False, dblog
             logger.save_to_disk()
 
 
+def _preload_data(logger):
+    # preload some data, so that we don't have to
+    # retrieve it from the DB later
+    all_users = db.m.User.query.all()
+    all_categories = db.m.Category.query.all()
+    logger.print_info('{} users, {} categories preloaded'.format(len(all_users), len(all_categories)), always=True)
+
+
 def db_has_data():
     """Check if there is already data in the DB"""
     models = ('Category', 'User', 'LocalGroup', 'NewsItem', 'IPNetworkGroup', 'LegacyCategoryMapping',
@@ -141,7 +284,7 @@ def db_has_data():
     return False
 
 
-def setup(logger, zodb_root, sqlalchemy_uri, dblog=False, restore=False):
+def setup(logger, zodb_root, sqlalchemy_uri, dblog=False, restore=False, fast_db=False):
     app = IndicoFlask('indico_migrate')
     app.config['PLUGINENGINE_NAMESPACE'] = 'indico.plugins'
     app.config['SQLALCHEMY_DATABASE_URI'] = sqlalchemy_uri
@@ -175,6 +318,9 @@ def setup(logger, zodb_root, sqlalchemy_uri, dblog=False, restore=False):
         tz = pytz.utc
 
     with app.app_context():
+        if fast_db:
+            event.listen(db.engine, 'connect', _apply_fast_db_settings)
+            logger.print_info('Database profile: %[cyan]{}'.format(_describe_db_profile(fast_db)), always=True)
         if not restore:
             all_tables = sum(get_all_tables(db).values(), [])
             if all_tables:
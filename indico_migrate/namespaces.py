@@ -16,19 +16,227 @@
 
 from __future__ import unicode_literals
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from copy import copy
+from itertools import chain, islice
+from threading import Lock
 
 from persistent import Persistent
+from sqlalchemy import inspect
 from yaml import Dumper, Loader
 
 from indico.core.db import db
 
 
+_missing = object()
+
+
+class IdIndex(object):
+    """A mapping storing the ids of SQLAlchemy objects instead of the objects.
+
+    Keeping hundreds of thousands of users/events/categories in the global
+    namespace would keep them (and everything they have loaded) in memory
+    for the whole migration.  This mapping only keeps the primary keys and
+    loads the objects when they are accessed; the most recently used ones
+    are kept in a small LRU cache.
+
+    Objects are always returned from the session of the current thread, so
+    they can be used by isolated steps as well.
+
+    All instances are registered in `instances` so their cache size can be
+    adjusted and their hit rate reported for the whole migration.
+
+    :param model_name: The name of the model of the objects (in ``db.m``)
+    :param ids: A dict mapping keys to ids
+    :param cache_size: The number of loaded objects to keep (defaults to
+                       `default_cache_size`)
+    """
+
+    instances = []
+    default_cache_size = 1000
+
+    def __init__(self, model_name, ids=None, cache_size=None):
+        self.model_name = model_name
+        #: The name of the namespace store, used when reporting the hit rate
+        self.name = model_name
+        self.cache_size = cache_size if cache_size is not None else IdIndex.default_cache_size
+        self.hits = 0
+        self.misses = 0
+        self._ids = dict(ids or {})
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        IdIndex.instances.append(self)
+
+    @property
+    def model(self):
+        return getattr(db.m, self.model_name)
+
+    def _get_object_id(self, obj):
+        if obj is None:
+            return None
+        identity = inspect(obj).identity
+        if identity is not None:
+            return identity[0]
+        if obj.id is None:
+            # the id is assigned by the database
+            db.session.flush()
+        return obj.id
+
+    def _trim(self):
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _cache_object(self, obj_id, obj):
+        with self._lock:
+            self._cache.pop(obj_id, None)
+            self._cache[obj_id] = obj
+            self._trim()
+
+    def _get_cached(self, obj_id):
+        with self._lock:
+            obj = self._cache.pop(obj_id, None)
+            if obj is not None:
+                self._cache[obj_id] = obj
+            # the object may be from another thread's session or have been expunged
+            if obj is None or obj not in db.session:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return obj
+
+    def resize(self, cache_size):
+        with self._lock:
+            self.cache_size = cache_size
+            self._trim()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (self.hits / float(total)) if total else 0
+
+    def _load(self, obj_id):
+        if obj_id is None:
+            return None
+        obj = self._get_cached(obj_id)
+        if obj is None:
+            obj = self.model.get(obj_id)
+            if obj is not None:
+                self._cache_object(obj_id, obj)
+        return obj
+
+    def _load_many(self, obj_ids):
+        objects = {}
+        missing = set()
+        for obj_id in obj_ids:
+            if obj_id is None:
+                continue
+            obj = self._get_cached(obj_id)
+            if obj is None:
+                missing.add(obj_id)
+            else:
+                objects[obj_id] = obj
+        if missing:
+            model = self.model
+            for obj in model.query.filter(model.id.in_(missing)):
+                objects[obj.id] = obj
+                self._cache_object(obj.id, obj)
+        return objects
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def iterkeys(self):
+        return self._ids.iterkeys()
+
+    def keys(self):
+        return self._ids.keys()
+
+    def __getitem__(self, key):
+        return self._load(self._ids[key])
+
+    def get(self, key, default=None):
+        obj_id = self._ids.get(key, _missing)
+        return default if obj_id is _missing else self._load(obj_id)
+
+    def __setitem__(self, key, obj):
+        obj_id = self._get_object_id(obj)
+        self._ids[key] = obj_id
+        if obj is not None:
+            self._cache_object(obj_id, obj)
+
+    def __delitem__(self, key):
+        del self._ids[key]
+
+    def pop(self, key, default=_missing):
+        if default is _missing:
+            return self._load(self._ids.pop(key))
+        obj_id = self._ids.pop(key, _missing)
+        return default if obj_id is _missing else self._load(obj_id)
+
+    def clear(self):
+        self._ids.clear()
+
+    def update(self, other):
+        if isinstance(other, IdIndex):
+            self._ids.update(other._ids)
+            return
+        items = other.iteritems() if isinstance(other, dict) else other
+        for key, obj in items:
+            self[key] = obj
+
+    def iteritems(self, chunk_size=1000):
+        """Iterate over all keys and objects, loading the objects in chunks"""
+        it = self._ids.iteritems()
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+            objects = self._load_many(obj_id for key, obj_id in chunk)
+            for key, obj_id in chunk:
+                yield key, objects.get(obj_id)
+
+    def itervalues(self):
+        return (obj for key, obj in self.iteritems())
+
+    def get_id(self, key, default=None):
+        """Get the id of the object for `key` without loading it"""
+        return self._ids.get(key, default)
+
+    def pop_id(self, key, default=None):
+        """Remove `key` and return the id of its object without loading it"""
+        return self._ids.pop(key, default)
+
+    def set_id(self, key, obj_id):
+        """Map `key` to the object with the given id"""
+        self._ids[key] = obj_id
+
+    def iter_id_items(self):
+        """Iterate over all keys and object ids without loading any object"""
+        return self._ids.iteritems()
+
+
+def set_id_index_cache_size(cache_size):
+    """Set the number of loaded objects kept by each `IdIndex`"""
+    IdIndex.default_cache_size = cache_size
+    for index in IdIndex.instances:
+        index.resize(cache_size)
+
+
 def sqlalchemy_representer(dumper, obj):
     return dumper.represent_sequence('!sqlalchemy', [obj.__class__.__name__,
                                                      obj.id])
 
 
+def id_index_representer(dumper, obj):
+    return dumper.represent_mapping('!idindex', {'model': obj.model_name, 'ids': obj._ids})
+
+
 def zodb_representer(dumper, obj):
     return dumper.represent_sequence('!zodb', [obj._p_oid])
 
@@ -41,6 +249,11 @@ def sqlalchemy_constructor(loader, node):
     return getattr(db.m, data[0]).get(data[1])
 
 
+def id_index_constructor(loader, node):
+    data = loader.construct_mapping(node, deep=True)
+    return IdIndex(data['model'], data['ids'])
+
+
 def zodb_constructor(loader, node):
     oid = loader.construct_sequence(node)[0]
     return loader.zodb_root._p_jar[oid]
@@ -48,26 +261,228 @@ def zodb_constructor(loader, node):
 
 Dumper.add_multi_representer(db.Model, sqlalchemy_representer)
 Dumper.add_multi_representer(Persistent, zodb_representer)
+Dumper.add_representer(IdIndex, id_index_representer)
 Loader.add_constructor('!sqlalchemy', sqlalchemy_constructor)
+Loader.add_constructor('!idindex', id_index_constructor)
 Loader.add_constructor('!zodb', zodb_constructor)
 
 
 STORE_MAP = {
-    'setdict': lambda: defaultdict(set)
+    'setdict': lambda: defaultdict(set),
+    'user_index': lambda: IdIndex('User'),
+    'event_index': lambda: IdIndex('Event'),
+    'category_index': lambda: IdIndex('Category'),
+    'survey_index': lambda: IdIndex('Survey'),
 }
 
 
+_MUTABLE_VALUE_TYPES = (set, list, dict)
+
+
+class _JournalingStore(object):
+    """Proxy for a store recording the previous values of modified keys
+
+    Since mutable values (e.g. sets) may be modified in place, they are
+    replaced with a (shallow) copy the first time they are accessed (by
+    key or by iterating over the values) and the original value is
+    recorded.  All other methods of the store are read-only and passed
+    through.
+
+    :param store: The store to proxy
+    :param journal: The list the previous values are recorded in
+    :param recorded: The set of ``(id(store), key)`` tuples whose previous
+                     value has already been recorded
+    """
+
+    def __init__(self, store, journal, recorded):
+        self._store = store
+        self._journal = journal
+        self._recorded = recorded
+
+    def _remember(self, key):
+        store = self._store
+        if isinstance(store, IdIndex):
+            old = store.get_id(key, _missing)
+        else:
+            old = dict.get(store, key, _missing)
+        self._journal.append((store, key, old))
+        self._recorded.add((id(store), key))
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __getitem__(self, key):
+        store = self._store
+        if not isinstance(store, IdIndex) and (id(store), key) not in self._recorded:
+            if key not in store:
+                if isinstance(store, defaultdict):
+                    self._remember(key)
+            elif isinstance(dict.__getitem__(store, key), _MUTABLE_VALUE_TYPES):
+                self._remember(key)
+                store[key] = copy(dict.__getitem__(store, key))
+        return store[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._store else default
+
+    def iteritems(self):
+        if isinstance(self._store, IdIndex):
+            return self._store.iteritems()
+        return ((key, self[key]) for key in list(self._store))
+
+    def itervalues(self):
+        return (value for key, value in self.iteritems())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def setdefault(self, key, default=None):
+        if key not in self._store:
+            self[key] = default
+        return self[key]
+
+    def update(self, other):
+        if isinstance(other, IdIndex):
+            for key, obj_id in other.iter_id_items():
+                self.set_id(key, obj_id)
+            return
+        items = other.iteritems() if isinstance(other, dict) else other
+        for key, value in items:
+            self[key] = value
+
+    def clear(self):
+        for key in list(self._store):
+            self._remember(key)
+        self._store.clear()
+
+    def popitem(self):
+        if not self._store:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(iter(self._store))
+        return key, self.pop(key)
+
+    def __setitem__(self, key, value):
+        self._remember(key)
+        self._store[key] = value
+
+    def __delitem__(self, key):
+        self._remember(key)
+        del self._store[key]
+
+    def pop(self, key, *args):
+        self._remember(key)
+        return self._store.pop(key, *args)
+
+    def set_id(self, key, obj_id):
+        self._remember(key)
+        self._store.set_id(key, obj_id)
+
+    def pop_id(self, key, default=None):
+        self._remember(key)
+        return self._store.pop_id(key, default)
+
+
+def _restore_value(store, key, value):
+    if isinstance(store, IdIndex):
+        if value is _missing:
+            store.pop_id(key)
+        else:
+            store.set_id(key, value)
+    elif value is _missing:
+        store.pop(key, None)
+    else:
+        store[key] = value
+
+
 class SharedNamespace(object):
     def __init__(self, name, zodb_root, store_types):
         self.name = name
         self._store_types = store_types
-        self._stores = {k: STORE_MAP.get(ktype, ktype)() for k, ktype in store_types.viewitems()}
+        self._stores = {}
+        self._journal = None
+        self._journal_recorded = None
+        self._journal_attrs = None
+        self.load({k: STORE_MAP.get(ktype, ktype)() for k, ktype in store_types.viewitems()})
 
     def __getattr__(self, key):
-        return self._stores[key]
+        store = self._stores[key]
+        if self._journal is not None and isinstance(store, (dict, IdIndex)):
+            return _JournalingStore(store, self._journal, self._journal_recorded)
+        return store
+
+    def __setattr__(self, key, value):
+        stores = self.__dict__.get('_stores', {})
+        if key not in stores:
+            object.__setattr__(self, key, value)
+            return
+        # values stored directly in the namespace (e.g. ``lostandfound_category``)
+        if self._journal is not None:
+            self._journal.append((stores, key, stores[key]))
+        stores[key] = value
+
+    def begin_journal(self):
+        """Start recording changes so they can be undone with `rollback_journal`.
+
+        All changes made through the stores (assignments, deletions, pops,
+        updates, ...) and assignments of the values stored directly in the
+        namespace are recorded.  Mutable values (e.g. sets) retrieved from
+        a store are copied first, so modifying them in place is undone as
+        well.
+        """
+        self._journal = []
+        self._journal_recorded = set()
+        self._journal_attrs = {k: v for k, v in self.__dict__.iteritems() if not k.startswith('_')}
+
+    def end_journal(self):
+        """Stop recording changes and keep them"""
+        self._journal = self._journal_recorded = self._journal_attrs = None
+
+    def rollback_journal(self):
+        """Undo all changes recorded since `begin_journal`"""
+        for store, key, value in reversed(self._journal):
+            _restore_value(store, key, value)
+        for key in [k for k in self.__dict__ if not k.startswith('_') and k not in self._journal_attrs]:
+            del self.__dict__[key]
+        self.__dict__.update(self._journal_attrs)
+        self.end_journal()
 
     def serialize(self):
         return {k: store for k, store in self._stores.viewitems()}
 
+    def iter_objects(self, dicts=True):
+        """Iterate over all SQLAlchemy objects stored in the namespace
+
+        :param dicts: Whether to include the objects stored in dicts or
+                      only those stored directly in the namespace
+        """
+        for store in self._stores.itervalues():
+            if isinstance(store, IdIndex):
+                continue
+            elif not isinstance(store, dict):
+                items = [store]
+            elif not dicts:
+                continue
+            else:
+                items = chain(store.iterkeys(), chain.from_iterable(v if isinstance(v, (set, frozenset, list, tuple))
+                                                                    else [v] for v in store.itervalues()))
+            for item in items:
+                if isinstance(item, db.Model):
+                    yield item
+
     def load(self, data):
+        for key, store in data.viewitems():
+            if isinstance(store, IdIndex):
+                store.name = key
         self._stores.update(data)
@@ -0,0 +1,74 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+"""Events which could not be migrated.
+
+When events are migrated in isolation, an event failing to migrate does
+not abort the migration.  Everything done for it is rolled back and it
+is recorded in the quarantine file (one JSON object per line) together
+with the error, so it can be fixed and migrated again later.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import os
+import traceback
+
+from indico.util.date_time import now_utc
+
+from indico_migrate.util import convert_to_unicode
+
+
+def _to_unicode(value):
+    return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+
+class Quarantine(object):
+    """The quarantine file of a migration run.
+
+    Entries from previous runs are discarded since the events are either
+    migrated by this run or quarantined again.
+
+    :param path: The path of the quarantine file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        open(path, 'w').close()
+
+    def add(self, conf, exc_info):
+        """Record an event that failed to migrate"""
+        entry = {
+            'event_id': conf.id,
+            'title': convert_to_unicode(getattr(conf, 'title', '')),
+            'error': _to_unicode(''.join(traceback.format_exception_only(*exc_info[:2]))).strip(),
+            'traceback': _to_unicode(''.join(traceback.format_exception(*exc_info))),
+            'timestamp': now_utc().isoformat()
+        }
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.count += 1
+        return entry
+
+
+def load_quarantined_ids(path):
+    """Get the legacy ids of the events recorded in a quarantine file"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {json.loads(line)['event_id'] for line in f if line.strip()}
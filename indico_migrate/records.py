@@ -0,0 +1,244 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+"""Plain-data snapshots of legacy ZODB objects.
+
+The functions in here turn legacy objects into records made only of
+basic Python types.  Those records are what the importers consume,
+regardless of whether they are built on the fly from the ZODB or read
+back from a dump created by ``indico-migrate-extract``.
+
+Values are kept as raw as possible (e.g. strings are not converted to
+unicode) so the importers still apply the very same sanitization no
+matter where the record comes from.
+"""
+
+from __future__ import unicode_literals
+
+import base64
+import gzip
+import json
+import os
+from datetime import date, datetime
+
+import pytz
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _identity_record(identity):
+    return {
+        'type': identity.__class__.__name__,
+        'login': identity.login,
+        'password': getattr(identity, 'password', None),
+        'algorithm': getattr(identity, 'algorithm', None)
+    }
+
+
+def _api_key_record(ak):
+    return {
+        'key': ak._key,
+        'sign_key': ak._signKey,
+        'is_blocked': ak._isBlocked,
+        'persistent_allowed': getattr(ak, '_persistentAllowed', False),
+        'created_dt': ak._createdDT,
+        'last_used_dt': ak._lastUsedDT,
+        'last_used_ip': ak._lastUsedIP,
+        'last_path': ak._lastPath,
+        'last_query': ak._lastQuery,
+        'last_use_authenticated': ak._lastUseAuthenticated,
+        'use_count': ak._useCount,
+        'old_keys': list(ak._oldKeys)
+    }
+
+
+def avatar_record(avatar):
+    """Get a record containing everything the user import needs from an Avatar"""
+    merge_to = getattr(avatar, '_mergeTo', None)
+    if merge_to:
+        return {'id': avatar.id, 'merge_to': merge_to.id}
+    elif avatar.status == 'Not confirmed':
+        return {'id': avatar.id, 'merge_to': None, 'status': avatar.status}
+
+    has_links = None
+    if not avatar.name.strip() and not avatar.surName.strip():
+        has_links = any(objs for x in avatar.linkedTo.itervalues() for objs in x.itervalues())
+    personal_info = getattr(avatar, 'personalInfo', None)
+    api_key = getattr(avatar, 'apiKey', None)
+    return {
+        'id': avatar.id,
+        'merge_to': None,
+        'merge_from': [x.id for x in getattr(avatar, '_mergeFrom', ())],
+        'status': avatar.status,
+        'name': avatar.name,
+        'surname': avatar.surName,
+        'title': avatar.title,
+        'email': avatar.email,
+        'secondary_emails': list(avatar.secondaryEmails),
+        'phone': avatar.telephone[0],
+        'affiliation': avatar.organisation[0],
+        'address': avatar.address[0],
+        'timezone': avatar.timezone,
+        'lang': avatar._lang,
+        'display_tz_mode': avatar.displayTZMode,
+        'show_past_events': bool(getattr(personal_info, '_showPastEvents', False)),
+        'unlocked_fields': list(getattr(avatar, 'unlockedFields', [])),
+        'has_links': has_links,
+        'identities': map(_identity_record, avatar.identities),
+        'api_key': _api_key_record(api_key) if api_key else None,
+        'favorite_categories': [categ.id for categ in avatar.linkedTo['category']['favorite'] if categ],
+        'favorite_users': list(personal_info._basket._users) if personal_info is not None else []
+    }
+
+
+def reservation_record(resv):
+    """Get a record containing everything the booking import needs from a Reservation"""
+    event_id = getattr(resv, '_ReservationBase__owner', None)
+    if hasattr(event_id, '_Impersistant__obj'):  # Impersistant object
+        event_id = event_id._Impersistant__obj
+    history = getattr(resv, 'resvHistory', None)
+    return {
+        'id': resv.id,
+        'room_id': resv.room.id,
+        'created_dt': resv._utcCreatedDT,
+        'start_dt': resv._utcStartDT,
+        'end_dt': resv._utcEndDT,
+        'repeatability': resv.repeatability,
+        'booked_for_id': getattr(resv, 'bookedForId', None),
+        'booked_for_name': resv.bookedForName,
+        'created_by': resv.createdBy,
+        'is_cancelled': resv.isCancelled,
+        'is_confirmed': resv.isConfirmed,
+        'is_rejected': resv.isRejected,
+        'reason': resv.reason,
+        'rejection_reason': getattr(resv, 'rejectionReason', None),
+        'uses_vc': getattr(resv, 'usesAVC', False),
+        'needs_vc_assistance': getattr(resv, 'needsAVCSupport', False),
+        'needs_assistance': getattr(resv, 'needsAssistance', False),
+        'used_vc': list(getattr(resv, 'useVC', [])),
+        'history': [{'timestamp': h._timestamp, 'user': h._responsibleUser, 'info': list(h._info)}
+                    for h in reversed(history._entries)] if history else [],
+        'notifications': list(getattr(resv, 'startEndNotification', []) or []),
+        'excluded_days': list(getattr(resv, '_excludedDays', []) or []),
+        'event_id': event_id
+    }
+
+
+def _encode(value):
+    # JSON strings are read back as byte strings since that is what legacy
+    # objects almost always contain; unicode values are tagged instead
+    if isinstance(value, str):
+        try:
+            value.decode('ascii')
+        except UnicodeDecodeError:
+            return {'$bytes': base64.b64encode(value)}
+        return value
+    elif isinstance(value, unicode):
+        return {'$unicode': value}
+    elif isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return {'$utc': value.astimezone(pytz.utc).replace(tzinfo=None).isoformat()}
+        return {'$datetime': value.isoformat()}
+    elif isinstance(value, date):
+        return {'$date': value.isoformat()}
+    elif isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.iteritems()}
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return map(_encode, value)
+    return value
+
+
+def _parse_datetime(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def _decode_object(obj):
+    if len(obj) == 1:
+        key, value = next(obj.iteritems())
+        if key == '$bytes':
+            return base64.b64decode(value)
+        elif key == '$unicode':
+            return value
+        elif key == '$datetime':
+            return _parse_datetime(value)
+        elif key == '$utc':
+            return pytz.utc.localize(_parse_datetime(value))
+        elif key == '$date':
+            return datetime.strptime(value, '%Y-%m-%d').date()
+    return {k: _decode(v) for k, v in obj.iteritems()}
+
+
+def _decode(value):
+    if isinstance(value, unicode):
+        return value.encode('ascii')
+    elif isinstance(value, dict):
+        return _decode_object(value)
+    elif isinstance(value, list):
+        return map(_decode, value)
+    return value
+
+
+def dump_record(record):
+    """Serialize a record to a single line of JSON"""
+    return json.dumps(_encode(record), separators=(',', ':'))
+
+
+def load_record(line):
+    """Deserialize a record created by `dump_record`"""
+    return _decode(json.loads(line))
+
+
+def write_records(path, records):
+    """Write records to a gzipped line-delimited JSON file.
+
+    The data is written to a temporary file which is only renamed once
+    everything has been written, so an interrupted run never leaves a
+    partial file behind.
+
+    :return: the number of records written
+    """
+    count = 0
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as f:
+        for record in records:
+            f.write(dump_record(record).encode('ascii') + b'\n')
+            count += 1
+    os.rename(tmp_path, path)
+    return count
+
+
+class DumpReader(object):
+    """Read records from a directory created by ``indico-migrate-extract``"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+
+    def has_domain(self, domain):
+        return domain in self.manifest
+
+    def count(self, domain):
+        return sum(part['count'] for part in self.manifest[domain]['parts'])
+
+    def iter_records(self, domain):
+        # partitions cover consecutive key ranges, so reading them in order
+        # yields the records in the same order as iterating over the BTree
+        for part in self.manifest[domain]['parts']:
+            with gzip.open(os.path.join(self.path, part['file']), 'rb') as f:
+                for line in f:
+                    yield load_record(line)
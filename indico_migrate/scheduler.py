@@ -0,0 +1,129 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import sys
+from Queue import Queue
+from threading import Thread
+
+from indico.core.db import db
+
+
+class StepScheduler(object):
+    """Run top-level steps as soon as the steps they depend on are done.
+
+    Steps exchanging ORM objects through the global namespace share the
+    database session and thus run one after another in the main thread,
+    in the order they were given.  Isolated steps run in a thread of their
+    own, with a separate app context (i.e. database session) and ZODB
+    connection, while the main thread continues with other steps.
+
+    :param logger: The migration logger
+    :param app: The Flask app
+    :param zodb_root: The ZODB root used by the main thread
+    :param steps: The steps to run
+    :param run_step: A function running a step, called with the step
+                     class and the ZODB root to use
+    :param available: The requirements satisfied by steps which do not
+                      need to run (anymore)
+    """
+
+    def __init__(self, logger, app, zodb_root, steps, run_step, available=()):
+        self.logger = logger
+        self.app = app
+        self.zodb_root = zodb_root
+        self.steps = list(steps)
+        self.run_step = run_step
+        self.provided = set(available)
+        self._check_requirements()
+
+    def _check_requirements(self):
+        available = set(self.provided)
+        for step in self.steps:
+            available |= step.provides
+        for step in self.steps:
+            missing = step.requires - available
+            if missing:
+                raise ValueError('Requirements of {} are not provided by any step: {}'
+                                 .format(step.__name__, ', '.join(sorted(missing))))
+
+    def _run_isolated(self, step, finished):
+        exc_info = None
+        try:
+            with self.app.app_context():
+                conn = self.zodb_root._p_jar.db().open()
+                try:
+                    self.run_step(step, conn.root())
+                finally:
+                    db.session.remove()
+                    conn.close()
+        except Exception:
+            exc_info = sys.exc_info()
+        finished.put((step, exc_info))
+
+    def _step_done(self, step, exc_info):
+        if exc_info is None:
+            self.provided |= step.provides
+        elif self.exc_info is None:
+            self.exc_info = exc_info
+        else:
+            self.logger.print_error('%[red!]Step {} failed as well: {}'.format(step.__name__, exc_info[1]),
+                                    always=True)
+
+    def run(self):
+        pending = list(self.steps)
+        running = set()
+        finished = Queue()
+        self.exc_info = None
+        while pending or running:
+            while not finished.empty():
+                step, exc_info = finished.get()
+                running.discard(step)
+                self._step_done(step, exc_info)
+
+            ready = [s for s in pending if s.requires <= self.provided] if self.exc_info is None else []
+            for step in ready:
+                if step.isolated:
+                    self.logger.print_info('Starting step {} in the background'.format(step.__name__), always=True)
+                    pending.remove(step)
+                    running.add(step)
+                    thread = Thread(target=self._run_isolated, args=(step, finished), name=step.__name__)
+                    thread.daemon = True
+                    thread.start()
+
+            main_ready = [s for s in ready if not s.isolated]
+            if main_ready:
+                step = main_ready[0]
+                pending.remove(step)
+                try:
+                    self.run_step(step, self.zodb_root)
+                except Exception:
+                    self._step_done(step, sys.exc_info())
+                else:
+                    self._step_done(step, None)
+            elif running:
+                step, exc_info = finished.get()
+                running.discard(step)
+                self._step_done(step, exc_info)
+            elif pending and self.exc_info is None:
+                raise ValueError('Cannot run any of the remaining steps: {}'
+                                 .format(', '.join(step.__name__ for step in pending)))
+            else:
+                break
+
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
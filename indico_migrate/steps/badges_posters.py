@@ -30,6 +30,9 @@ from indico_migrate.util import LocalFileImporterMixin
 
 class GlobalBadgePosterImporter(LocalFileImporterMixin, TopLevelMigrationStep):
     step_name = 'badges'
+    requires = frozenset({'users.users', 'categories.categories', 'events.events'})
+    provides = frozenset({'indico.designer_templates'})
+    isolated = True
 
     def __init__(self, *args, **kwargs):
         self._set_config_options(**kwargs)
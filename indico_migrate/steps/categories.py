@@ -43,12 +43,19 @@ from indico_migrate.util import get_archived_file, patch_default_group_provider,
 
 class CategoryImporter(AttachmentMixin, TopLevelMigrationStep):
     step_name = 'categories'
+    supports_delta = True
+    requires = frozenset({'avatar_merged_user', 'all_groups', 'user_favorite_categories', 'users_by_primary_email',
+                          'users_by_secondary_email', 'users.users', 'indico.ip_network_groups'})
+    provides = frozenset({'legacy_category_ids', 'categories.categories'})
 
     def __init__(self, *args, **kwargs):
         self._set_config_options(**kwargs)
         self.system_user = User.get_system_user()
         super(CategoryImporter, self).__init__(*args, **kwargs)
         self.categ_id_counter = self.zodb_root['counters']['CATEGORY']._Counter__count
+        if self.delta is not None:
+            # ids generated for legacy categories may be higher than the counter
+            self.categ_id_counter = max(self.categ_id_counter, db.session.query(db.func.max(Category.id)).scalar())
 
     @no_autoflush
     @step_description('Categories')
@@ -61,10 +68,39 @@ class CategoryImporter(AttachmentMixin, TopLevelMigrationStep):
     def migrate_categories(self):
         old_root = self.zodb_root['rootCategory']
         assert old_root.id == '0'
+        if self.delta is not None:
+            if old_root.id in self.delta.changed['categories']:
+                self._update_category(old_root, None)
+            self._migrate_category_changes(old_root)
+            db.session.commit()
+            return
         root = self._migrate_category(old_root, 1)
         db.session.add(root)
         db.session.commit()
 
+    def _migrate_category_changes(self, old_cat):
+        """Apply the changes made since the last migration to a category's subtree"""
+        cat = self.global_ns.legacy_category_ids[old_cat.id]
+        for old_subcat in sorted(old_cat.subcategories.itervalues(), key=attrgetter('_order')):
+            if old_subcat.id in self.delta.new['categories']:
+                # the whole subtree of a new category is new as well
+                cat.children.append(self._migrate_category(old_subcat, len(cat.children) + 1))
+                continue
+            elif old_subcat.id in self.delta.changed['categories']:
+                self._update_category(old_subcat, cat)
+            self._migrate_category_changes(old_subcat)
+
+    def _update_category(self, old_cat, parent):
+        cat = self.global_ns.legacy_category_ids[old_cat.id]
+        cat.title = self._fix_title(convert_to_unicode(old_cat.name), old_cat.id)
+        cat.description = convert_to_unicode(old_cat.description)
+        cat.visibility = self._get_visibility(old_cat)
+        cat.timezone = convert_to_unicode(getattr(old_cat, '_timezone', self.makac_info._timezone))
+        if parent is not None and cat.parent != parent:
+            self.print_warning('Moving category to {}'.format(parent.id), event_id=old_cat.id)
+            cat.parent = parent
+        self.print_success('{} (updated)'.format(cat.title), event_id=cat.id)
+
     def _process_icon(self, cat, icon):
         path = get_archived_file(icon, self.archive_dirs)[1]
         if path is None:
@@ -179,13 +215,17 @@ class CategoryImporter(AttachmentMixin, TopLevelMigrationStep):
             self.print_warning('%[red!]{}%[reset] => %[green!]{}%[reset]'.format(orig, title))
         return title
 
-    def _migrate_category(self, old_cat, position):
+    def _get_visibility(self, old_cat):
         # unlimited visibility is 999 but we have a 994 for some reason.. since nobody
         # has 900 levels of nesting we can just go for that threshold instead
         visibility = None if old_cat._visibility > 900 else old_cat._visibility
         if visibility == 0:
             self.print_warning("Raising visibility from 'invisible' to 'category-only'", event_id=old_cat.id)
             visibility = 1
+        return visibility
+
+    def _migrate_category(self, old_cat, position):
+        visibility = self._get_visibility(old_cat)
         emails = re.split(r'[\s;,]+', convert_to_unicode(getattr(old_cat, '_notifyCreationList', '')))
         emails = {sanitize_email(email).lower() for email in emails}
         emails = sorted(email for email in emails if is_valid_mail(email, False))
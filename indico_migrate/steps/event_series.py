@@ -30,11 +30,29 @@ from indico.modules.events import Event, LegacyEventMapping
 from indico.modules.events.models.series import EventSeries
 from indico.util.string import is_legacy_id
 from indico_migrate.importer import TopLevelMigrationStep
-from indico_migrate.util import step_description
+from indico_migrate.util import DisjointSet, step_description
+
+
+MATERIAL_LINK_RE = re.compile(r'/(?:event|e)/(?P<event_id>\d+)/material/(?P<material_id>\d+)/?')
+EVENT_LINK_RE = re.compile(r'/(?:event|e)/(?P<event_id>\d+)/?')
+
+
+def _get_material_ref(link_url):
+    """Get the ``(event_id, material_id)`` of a link to legacy event material"""
+    parsed_url = urlparse.urlparse(link_url)
+    if parsed_url.query:
+        return None
+    match = MATERIAL_LINK_RE.search(parsed_url.path)
+    if match is None:
+        return None
+    return int(match.group('event_id')), match.group('material_id')
 
 
 class EventSeriesImporter(TopLevelMigrationStep):
     step_name = 'series'
+    requires = frozenset({'events.events'})
+    provides = frozenset({'events.series'})
+    isolated = True
 
     @step_description('Event series')
     def migrate(self):
@@ -72,54 +90,79 @@ class EventSeriesImporter(TopLevelMigrationStep):
                 except KeyError:
                     return None
         else:
-            match = re.search(r'/(?:event|e)/(?P<event_id>\d+)/material/(?P<material_id>\d+)/?', path)
-            if match is not None:
-                folder = (LegacyAttachmentFolderMapping.query
-                          .filter_by(event_id=match.group('event_id'), contribution_id=None, session_id=None,
-                                     subcontribution_id=None, material_id=match.group('material_id'))
-                          .one()
-                          .folder)
-                return self._extract_event_id(folder.attachments[0].link_url)
-            match = re.search(r'/(?:event|e)/(?P<event_id>\d+)/?', path)
+            material = _get_material_ref(link_url)
+            if material is not None:
+                try:
+                    return self._extract_event_id(self.material_links[material])
+                except KeyError:
+                    return None
+            match = EVENT_LINK_RE.search(path)
             event_id = match.group('event_id')
         return int(event_id)
 
-    def _extract_event_ids(self, event):
-        for folder in self.attachment_folders[event.id]:
+    def _extract_event_ids(self, event_id):
+        for folder in self.attachment_folders[event_id]:
             id_ = self._extract_event_id(folder.attachments[0].link_url)
             if id_ is None:
-                self.print_warning('Invalid event link: {}'.format(folder.attachments[0].link_url), event_id=event.id)
+                self.print_warning('Invalid event link: {}'.format(folder.attachments[0].link_url), event_id=event_id)
                 continue
             yield id_
 
+    def _load_material_links(self, links):
+        """Load the first attachment link of the legacy material folders the given links point to.
+
+        Those links may point to other materials, so this continues until
+        all materials which are reachable that way have been loaded.
+        """
+        self.material_links = {}
+        pending = set(filter(None, map(_get_material_ref, links)))
+        while pending:
+            query = (LegacyAttachmentFolderMapping
+                     .find(LegacyAttachmentFolderMapping.event_id.in_({event_id for event_id, _ in pending}),
+                           contribution_id=None, session_id=None, subcontribution_id=None)
+                     .options(joinedload('folder').joinedload('attachments')))
+            found = set()
+            for mapping in query:
+                key = (mapping.event_id, mapping.material_id)
+                if key in pending and mapping.folder.attachments:
+                    self.material_links[key] = link_url = mapping.folder.attachments[0].link_url
+                    found.add(_get_material_ref(link_url))
+            pending = found - set(self.material_links) - {None}
+
     def get_event_series(self):
         self.legacy_event_mapping = {x.legacy_event_id: x.event_id for x in LegacyEventMapping.query}
         self.attachment_folders = defaultdict(set)
-        folder_query = (AttachmentFolder.find(AttachmentFolder.linked_event_id.in_({e.id for e in self._events_query}))
+        event_ids = {e.id for e in self._events_query.options(load_only('id'))}
+        folder_query = (AttachmentFolder.find(AttachmentFolder.linked_event_id.in_(event_ids))
                         .filter(AttachmentFolder.title.op('~')('^part\d+$'))
                         .options(joinedload('attachments')))
         for af in folder_query:
             self.attachment_folders[af.linked_event_id].add(af)
+        self._load_material_links(folder.attachments[0].link_url
+                                  for folders in self.attachment_folders.itervalues()
+                                  for folder in folders)
 
-        series_list = []
-        series_map = {}
-        for event in self._events_query:
-            series_ids = {event.id} | set(self._extract_event_ids(event))
-            series = filter(None, (series_map.get(id_) for id_ in series_ids))
-            if not series:
-                series_list.append(series_ids)
-                for id_ in series_ids:
-                    series_map[id_] = series_ids
-            else:
-                assert len(set(map(frozenset, series))) == 1
-                if series[0] != series_ids:
-                    self.print_warning('Inconsistent series found; merging them', event_id=event.id)
-                    self.print_warning('Series IDs:    {}'.format(sorted(series[0])), event_id=event.id)
-                    self.print_warning('Reachable IDs: {}'.format(sorted(series_ids)), event_id=event.id)
-                    series[0] |= series_ids
-                    for id_ in series_ids:
-                        series_map[id_] = series_ids
-        return series_list
+        series = DisjointSet()
+        for event_id in sorted(event_ids):
+            for id_ in sorted({event_id} | set(self._extract_event_ids(event_id))):
+                # only merging two series which both contain other events is a conflict
+                if (id_ in series and series.size(id_) > 1 and series.size(event_id) > 1 and
+                        series.find(id_) != series.find(event_id)):
+                    self.print_warning('Inconsistent series found; merging them', event_id=event_id)
+                    self.print_warning('Series IDs:    {}'.format(self._get_series_ids(series, id_)),
+                                       event_id=event_id)
+                    self.print_warning('Reachable IDs: {}'.format(self._get_series_ids(series, event_id)),
+                                       event_id=event_id)
+                series.union(id_, event_id)
+
+        series_map = defaultdict(set)
+        for id_ in series:
+            series_map[series.find(id_)].add(id_)
+        return [series_map[key] for key in sorted(series_map)]
+
+    def _get_series_ids(self, series, event_id):
+        representative = series.find(event_id)
+        return sorted(id_ for id_ in series if series.find(id_) == representative)
 
     @property
     def _events_query(self):
@@ -16,6 +16,7 @@
 
 from __future__ import unicode_literals
 
+import sys
 from operator import attrgetter
 
 import pytz
@@ -27,10 +28,11 @@ from indico.modules.events.models.events import Event
 from indico.modules.events.models.settings import EventSetting
 from indico.modules.users import User
 from indico.util.string import is_legacy_id
-from indico.util.struct.iterables import committing_iterator
 
+from indico_migrate.delta import EventDataDeleter
 from indico_migrate.importer import TopLevelMigrationStep
 from indico_migrate.namespaces import SharedNamespace
+from indico_migrate.quarantine import Quarantine
 from indico_migrate.util import convert_to_unicode, step_description
 
 
@@ -104,11 +106,17 @@ class _EventContextBase(object):
 
     def create_event(self):
         if is_legacy_id(self.conf.id):
-            event_id = int(self.gen_event_id())
+            # events re-created by a delta migration keep their previous id
+            event_id = self.importer.previous_event_ids.get(self.conf.id) or int(self.gen_event_id())
             self.is_legacy = True
         else:
             event_id = int(self.conf.id)
 
+        if self.importer.delta is not None and Event.query.filter_by(id=event_id).has_rows():
+            self.importer.print_error('Event id {} is already used by another event!'.format(event_id),
+                                      event_id=self.conf.id)
+            raise SkipEvent
+
         try:
             parent_category = self.importer.global_ns.legacy_category_ids[self.conf._Conference__owners[0].id]
         except (IndexError, KeyError):
@@ -159,6 +167,12 @@ def EventContextFactory(counter, _importer):
 
 class EventImporter(TopLevelMigrationStep):
     step_name = 'event'
+    supports_delta = True
+    requires = frozenset({'avatar_merged_user', 'all_groups', 'users_by_primary_email', 'users_by_secondary_email',
+                          'users_by_email', 'legacy_category_ids', 'room_mapping', 'venue_mapping', 'ip_domains',
+                          'reference_types', 'users.users', 'categories.categories', 'roombooking.rooms'})
+    provides = frozenset({'legacy_event_ids', 'used_short_urls', 'legacy_survey_mapping', 'wf_registry',
+                          'lostandfound_category', 'event_booking_ids', 'events.events'})
 
     def __init__(self, *args, **kwargs):
         super(EventImporter, self).__init__(*args, **kwargs)
@@ -166,8 +180,10 @@ class EventImporter(TopLevelMigrationStep):
         self.system_user = User.get_system_user()
         self.migrate_broken_events = kwargs.get('migrate_broken_events')
         self.debug = kwargs.get('debug')
+        self.quarantine_file = kwargs.get('quarantine_file')
         self.kwargs = kwargs
         self.kwargs['system_user'] = self.system_user
+        self.previous_event_ids = {}
 
     def has_data(self):
         return (EventSetting.query.filter(EventSetting.module.in_(['core', 'contact'])).has_rows() or
@@ -200,27 +216,112 @@ class EventImporter(TopLevelMigrationStep):
 
         EventContext = EventContextFactory(self.zodb_root['counters']['CONFERENCE'], self)
 
-        for conf in committing_iterator(self._iter_events()):
-            context = EventContext(conf, self.debug)
-            try:
-                context.create_event()
-            except SkipEvent:
-                continue
-            for importer in importers:
-                with db.session.no_autoflush:
-                    context.run_step(importer)
-
+        deleter = None
+        it = self._iter_events()
+        if self.delta is None:
+            it = self.adaptive_committing_iterator(it)
+        else:
+            # changed events are deleted and re-created in a single transaction
+            deleter = EventDataDeleter()
+            self._delete_changed_events(deleter)
+            # ids generated for legacy events may be higher than the counter
+            EventContext.event_id_counter = max(EventContext.event_id_counter,
+                                                db.session.query(db.func.max(Event.id)).scalar() or 0)
+
+        quarantine = Quarantine(self.quarantine_file) if self.quarantine_file else None
+        for conf in it:
+            if quarantine is None:
+                self._migrate_event(EventContext(conf, self.debug), importers)
+            else:
+                self._migrate_event_isolated(EventContext(conf, self.debug), importers, quarantine)
+
+        if quarantine is not None and quarantine.count:
+            self.print_warning('%[yellow!]{} events have been quarantined; see {}'.format(quarantine.count,
+                                                                                      quarantine.path))
+        if deleter is not None:
+            db.session.flush()
+            restored = deleter.restore_references()
+            self.print_success('Restored {} references to re-created events'.format(restored), always=True)
         for importer in importers:
             importer.teardown()
         self.fix_sequences('events', {'events'})
 
+    def _migrate_event(self, context, importers):
+        conf = context.conf
+        try:
+            context.create_event()
+        except SkipEvent:
+            return
+        # remember the bookings linked to the event so the booking import does not need to load it again
+        booking_ids = {int(x.id) for x in getattr(conf, '_Conference__roomBookingGuids', []) if x.id is not None}
+        if booking_ids:
+            self.global_ns.event_booking_ids[conf.id] = booking_ids
+        for importer in importers:
+            with db.session.no_autoflush:
+                context.run_step(importer)
+
+    def _migrate_event_isolated(self, context, importers, quarantine):
+        """Migrate an event in a savepoint, quarantining it if anything fails.
+
+        The changes made to the global namespace are undone together with
+        the database changes, so the following events do not see anything
+        from a quarantined event.
+        """
+        self.global_ns.begin_journal()
+        try:
+            with db.session.begin_nested():
+                self._migrate_event(context, importers)
+        except Exception:
+            exc_info = sys.exc_info()
+            self.global_ns.rollback_journal()
+            entry = quarantine.add(context.conf, exc_info)
+            self.print_error('%[red!]Event quarantined:%[reset] {}'.format(entry['error']), event_id=context.conf.id)
+        else:
+            self.global_ns.end_journal()
+
+    def _delete_changed_events(self, deleter):
+        conf_ids = self.delta.changed['conferences'] | self.delta.deleted['conferences']
+        if self.event_subset is not None:
+            # events outside the subset are not re-created, so they must be kept
+            conf_ids &= self.event_subset
+        event_ids = {}
+        for conf_id in conf_ids:
+            event_id = self.global_ns.legacy_event_ids.pop_id(conf_id)
+            if event_id is not None:
+                event_ids[conf_id] = event_id
+        self.previous_event_ids = {conf_id: event_id for conf_id, event_id in event_ids.iteritems()
+                                   if conf_id in self.delta.changed['conferences']}
+        deleted_ids = set(event_ids.viewvalues())
+        # forget about the objects which are about to be deleted
+        for shorturl, event_id in list(self.global_ns.used_short_urls.iter_id_items()):
+            if event_id in deleted_ids:
+                del self.global_ns.used_short_urls[shorturl]
+        for conf in self.global_ns.legacy_survey_mapping.keys():
+            if conf.id in conf_ids:
+                del self.global_ns.legacy_survey_mapping[conf]
+        for conf_id in conf_ids:
+            self.global_ns.event_booking_ids.pop(conf_id, None)
+        deleter.delete(deleted_ids)
+        self.print_success('Deleted {} changed/deleted events'.format(len(deleted_ids)), always=True)
+
     def _iter_events(self):
+        conferences = self.zodb_root['conferences']
+        keys = None
+        if self.delta is not None:
+            keys = self.delta.affected('conferences')
+        if self.event_subset is not None:
+            keys = self.event_subset if keys is None else keys & self.event_subset
+        if keys is not None:
+            keys = sorted(key for key in keys if key in conferences)
+            confs, total = (conferences[key] for key in keys), len(keys)
+        else:
+            confs, total = conferences.itervalues(), len(conferences)
+
         def _it():
-            for conf in self.zodb_root['conferences'].itervalues():
+            for conf in confs:
                 dir(conf)  # make zodb load attrs
                 yield conf
         it = _it()
-        total = len(self.zodb_root['conferences'])
         if self.quiet:
             it = self.logger.progress_iterator('Migrating Events', it, total, attrgetter('id'),
                                                lambda x: getattr(x, 'title', ''))
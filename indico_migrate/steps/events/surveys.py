@@ -36,18 +36,15 @@ class EventSurveyImporter(EventMigrationStep):
     def __init__(self, *args, **kwargs):
         super(EventSurveyImporter, self).__init__(*args, **kwargs)
 
-    def initialize_global_ns(self, g):
-        g.legacy_survey_mapping = {}
-
     def migrate(self):
         evaluations = getattr(self.conf, '_evaluations', [])
         assert len(evaluations) < 2
 
         if evaluations and evaluations[0]._questions:
             survey = self.migrate_survey(evaluations[0])
-            self.global_ns.legacy_survey_mapping[self.conf] = survey
             db.session.add(survey)
             db.session.flush()
+            self.global_ns.legacy_survey_mapping[self.conf] = survey
 
     def migrate_survey(self, evaluation):
         survey = Survey(event=self.event)
@@ -36,6 +36,7 @@ def _sanitize_title(title, _ws_re=re.compile(r'\s+')):
 
 class GlobalPostEventsImporter(TopLevelMigrationStep):
     step_name = 'global_post'
+    requires = frozenset({'legacy_category_ids', 'legacy_event_ids', 'legacy_survey_mapping', 'events.events'})
 
     @step_description('Upcoming event settings')
     def migrate(self):
@@ -48,10 +49,9 @@ class GlobalPostEventsImporter(TopLevelMigrationStep):
         entries = []
         for entry in mod._objects:
             is_category = type(entry.obj).__name__ == 'Category'
-            try:
-                obj_id = (self.global_ns.legacy_category_ids[entry.obj.id].id if is_category
-                          else self.global_ns.event_ids[entry.obj.id].id)
-            except KeyError:
+            index = self.global_ns.legacy_category_ids if is_category else self.global_ns.legacy_event_ids
+            obj_id = index.get_id(entry.obj.id)
+            if obj_id is None:
                 self.print_warning('invalid id for upcoming events: {} (category: {})'.format(entry.obj.id,
                                                                                               is_category))
                 continue
@@ -70,6 +70,8 @@ class GlobalPostEventsImporter(TopLevelMigrationStep):
 
         today = date.today()
         for task in it:
+            if self.event_subset is not None and task.conf.id not in self.event_subset:
+                continue
             survey = self.global_ns.legacy_survey_mapping[task.conf]
             start_date = task.conf._evaluations[0].startDate.date()
             if start_date < today:
@@ -46,6 +46,7 @@ def _sanitize_title(title, _ws_re=re.compile(r'\s+')):
 
 class GlobalPreEventsImporter(TopLevelMigrationStep):
     step_name = 'global_pre'
+    provides = frozenset({'ip_domains', 'reference_types', 'indico.ip_network_groups'})
 
     def __init__(self, *args, **kwargs):
         self.reference_types = kwargs.pop('reference_types')
@@ -19,10 +19,13 @@ from __future__ import unicode_literals
 import re
 import time
 from datetime import datetime, timedelta
+from multiprocessing import Pool, Queue
+from threading import Thread
 
 from babel import dates
 
 from indico.core.db import db
+from indico.modules.rb.models.locations import Location
 from indico.modules.rb.models.reservation_edit_logs import ReservationEditLog
 from indico.modules.rb.models.reservation_occurrences import ReservationOccurrence
 from indico.modules.rb.models.reservations import RepeatMapping, Reservation
@@ -30,18 +33,55 @@ from indico.modules.rb.models.rooms import Room
 from indico.util.date_time import as_utc
 
 from indico_migrate.importer import TopLevelMigrationStep
-from indico_migrate.util import convert_to_unicode, step_description
+from indico_migrate.logger import WorkerLogger
+from indico_migrate.records import reservation_record
+from indico_migrate.steps.rooms_locations import get_equipment_map
+from indico_migrate.util import (UnbreakingDB, convert_to_unicode, get_storage, lru_memoize, partition_keys,
+                                 step_description)
 
 
 FRENCH_MONTH_NAMES = [(str(i), name[:3].encode('utf-8').lower())
                       for i, name in dates.get_month_names(locale='fr_FR').iteritems()]
 
+#: Month numbers by their lowercase abbreviation; English names are case-insensitive while
+#: French ones are only recognized in lowercase (just like in `parse_dt_string`)
+ENGLISH_MONTH_NUMBERS = {name.encode('utf-8').lower(): i
+                         for i, name in dates.get_month_names('abbreviated', locale='en').iteritems()}
+FRENCH_MONTH_NUMBERS = {}
+for _num, _name in FRENCH_MONTH_NAMES:
+    FRENCH_MONTH_NUMBERS.setdefault(_name, int(_num))
+del _num, _name
+
+TIMESTAMP_RE = re.compile(r'(\d{1,2})\s+(\S+)\s+(\d{4})\s+(\d{1,2}):(\d{1,2})\Z')
+OCCURRENCE_REJECTED_RE = re.compile(r'Booking occurrence of the (\d{1,2} \w{3} \d{4}) rejected')
+
 
 def utc_to_local(dt):
     assert dt.tzinfo is None
     return dt - timedelta(seconds=time.altzone)
 
 
+@lru_memoize(10000)
+def parse_timestamp(value):
+    """Parse a timestamp from the history of a legacy booking.
+
+    The timestamps look like ``01 Jan 2010 12:34``, with the month name
+    abbreviated in English or French.  Anything else is passed on to
+    `parse_dt_string`.  Parsed values are cached since many entries are
+    created in bulk.
+    """
+    match = TIMESTAMP_RE.match(value)
+    if match:
+        day, month, year, hour, minute = match.groups()
+        month = ENGLISH_MONTH_NUMBERS.get(month.lower()) or FRENCH_MONTH_NUMBERS.get(month)
+        if month is not None:
+            try:
+                return datetime(int(year), month, int(day), int(hour), int(minute))
+            except ValueError:
+                pass
+    return parse_dt_string(value)
+
+
 def parse_dt_string(value):
     try:
         return datetime.strptime(value, '%d %b %Y %H:%M')
@@ -54,102 +94,233 @@ def parse_dt_string(value):
         return datetime.strptime(value, '%d %m %Y %H:%M')
 
 
+#: The importer used by the worker processes of the parallel mode
+_parallel_importer = None
+#: The database connections a worker process inherited from the main process
+_inherited_pools = []
+
+
+def _init_worker(message_queue):
+    importer = _parallel_importer
+    importer.logger = WorkerLogger(importer.quiet, message_queue)
+    with importer.app.app_context():
+        # the inherited connections belong to the main process; they must never
+        # be closed (or even garbage-collected) here, so we keep them around and
+        # let the worker use a new connection pool
+        _inherited_pools.append(db.engine.pool)
+        db.engine.pool = db.engine.pool.recreate()
+    importer.rb_root = UnbreakingDB(get_storage(importer.rb_zodb_uri, read_only=True)).open().root()
+
+
+def _migrate_key_range(key_range):
+    importer = _parallel_importer
+    min_key, max_key = key_range
+    tree = importer.rb_root['Reservations']
+    with importer.app.app_context():
+        count = importer._migrate_reservations(reservation_record(resv)
+                                               for resv in tree.itervalues(min=min_key, max=max_key))
+    importer.rb_root._p_jar.cacheMinimize()
+    return count
+
+
 class RoomBookingsImporter(TopLevelMigrationStep):
     step_name = 'room_bookings'
+    extract_domain = 'bookings'
+    requires = frozenset({'avatar_merged_user', 'event_booking_ids', 'legacy_event_ids', 'roombooking.rooms',
+                          'events.events'})
+    provides = frozenset({'roombooking.reservations'})
+    isolated = True
 
     def __init__(self, *args, **kwargs):
         self.rb_root = kwargs.get('rb_root')
+        self.rb_zodb_uri = kwargs.get('rb_zodb_uri')
+        self.workers = kwargs.get('booking_workers') or 0
         super(RoomBookingsImporter, self).__init__(*args, **kwargs)
 
+    def _get_user_id(self, avatar_id):
+        return self.user_ids.get(avatar_id)
+
+    def _iter_event_reservations(self):
+        """Get the records of the bookings linked to the migrated subset of events"""
+        resv_ids = set()
+        for conf_id in self.event_subset:
+            resv_ids |= self.global_ns.event_booking_ids.get(conf_id, set())
+        tree = self.rb_root['Reservations']
+        reservations = filter(None, (tree.get(resv_id) for resv_id in sorted(resv_ids)))
+        return (reservation_record(resv) for resv in reservations), len(reservations)
+
+    def _get_rooms(self):
+        """Get the location id, location name and name of all rooms"""
+        query = db.session.query(Room.id, Room.location_id, Location.name, Room.name).join(Room.location)
+        return {room_id: (location_id, location_name, name) for room_id, location_id, location_name, name in query}
+
+    def _add_occurrences(self, r, v, rejection_reasons):
+        """Queue the occurrences of a reservation to be written with the current batch.
+
+        The dates are calculated without creating `ReservationOccurrence`
+        objects, which is a lot faster for long repeating bookings.
+        """
+        notifications = set(v['notifications'])
+        excluded_days = set(v['excluded_days'])
+        end_time = r.end_dt.time()
+        repetition = (r.repeat_frequency, r.repeat_interval)
+        for start_dt in ReservationOccurrence.iter_start_time(r.start_dt, r.end_dt, repetition):
+            day = start_dt.date()
+            reason = rejection_reasons.get(day)
+            self._pending_occurrences.append({
+                'reservation_id': r.id,
+                'start_dt': start_dt,
+                'end_dt': datetime.combine(day, end_time),
+                'notification_sent': day in notifications,
+                'is_rejected': r.is_rejected,
+                'is_cancelled': r.is_cancelled or day in excluded_days,
+                'rejection_reason': convert_to_unicode(reason) if reason is not None else None
+            })
+
     @step_description('Room Bookings')
     def migrate(self):
-        i = 1
-        for rid, v in self.rb_root['Reservations'].iteritems():
-            room = Room.get(v.room.id)
+        # only the ids are used so the step does not depend on the session the users are in
+        self.user_ids = {avatar_id: user_id
+                         for avatar_id, user_id in self.global_ns.avatar_merged_user.iter_id_items()
+                         if user_id is not None}
+        if self.workers > 1 and self.event_subset is None and self.dump is None:
+            count = self._migrate_parallel()
+        else:
+            if self.workers > 1:
+                self.print_warning('%[yellow]Migrating bookings serially since they are not read from the ZODB')
+            if self.event_subset is not None:
+                reservations, total = self._iter_event_reservations()
+            else:
+                reservations, total = self.iter_records(self.rb_root['Reservations'], reservation_record)
+            count = self._migrate_reservations(reservations)
+        self.fix_sequences('roombooking')
+        self._check_count(count)
+
+    def _migrate_parallel(self):
+        """Migrate the bookings in worker processes, each handling a range of ids"""
+        global _parallel_importer
+        ranges = partition_keys(self.rb_root['Reservations'], self.workers * 4)
+        self.print_info('Migrating bookings in %[cyan]{}%[reset] chunks using %[cyan]{}%[reset] processes'
+                        .format(len(ranges), self.workers), always=True)
+        # the workers are forked, so our connection must not be in use
+        db.session.commit()
+        db.session.close()
+        _parallel_importer = self
+        # the messages of the workers are printed while they are running; the queue is bounded
+        # so a worker waits instead of buffering everything if the messages cannot be printed fast enough
+        message_queue = Queue(10000)
+        pool = Pool(self.workers, initializer=_init_worker, initargs=(message_queue,))
+        # only started once the workers have been forked
+        printer = Thread(target=self._print_worker_messages, args=(message_queue,), name='booking-worker-messages')
+        printer.daemon = True
+        printer.start()
+        count = 0
+        try:
+            for chunk_count in pool.imap_unordered(_migrate_key_range, ranges):
+                count += chunk_count
+        finally:
+            pool.close()
+            pool.join()
+            message_queue.put(None)
+            printer.join()
+            _parallel_importer = None
+        return count
+
+    def _print_worker_messages(self, message_queue):
+        for msg in iter(message_queue.get, None):
+            self.logger.print_msg(*msg)
+
+    def _check_count(self, count):
+        existing = Reservation.query.count()
+        if existing != count:
+            self.print_error('%[red!]{} bookings have been migrated but the database contains {}'
+                             .format(count, existing))
+        else:
+            self.print_success('{} bookings migrated'.format(count), always=True)
+
+    def _migrate_reservations(self, reservations):
+        """Migrate the given booking records
+
+        :return: the number of bookings that have been migrated
+        """
+        count = 0
+        # rooms and equipment are looked up in memory instead of querying them for every booking
+        rooms = self._get_rooms()
+        equipment = get_equipment_map()
+        event_booking_ids = self.global_ns.event_booking_ids
+        legacy_event_ids = self.global_ns.legacy_event_ids
+        self._pending_occurrences = []
+        for v in self.batch_committing_iterator(reservations, ReservationOccurrence.__table__,
+                                                self._pending_occurrences, 1000):
+            room = rooms.get(v['room_id'])
             if room is None:
-                self.print_error('skipping resv for dead room {0.room.id}: {0.id} ({0._utcCreatedDT})'.format(v))
+                self.print_error('skipping resv for dead room {0[room_id]}: {0[id]} ({0[created_dt]})'.format(v))
                 continue
 
-            repeat_frequency, repeat_interval = RepeatMapping.convert_legacy_repeatability(v.repeatability)
-            booked_for_id = getattr(v, 'bookedForId', None)
+            repeat_frequency, repeat_interval = RepeatMapping.convert_legacy_repeatability(v['repeatability'])
 
+            location_id, location_name, room_name = room
             r = Reservation(
-                id=v.id,
-                room=room,
-                created_dt=as_utc(v._utcCreatedDT),
-                start_dt=utc_to_local(v._utcStartDT),
-                end_dt=utc_to_local(v._utcEndDT),
-                booked_for_user=self.global_ns.avatar_merged_user.get(booked_for_id),
-                booked_for_name=convert_to_unicode(v.bookedForName),
-                created_by_user=self.global_ns.avatar_merged_user.get(v.createdBy),
-                is_cancelled=v.isCancelled,
-                is_accepted=v.isConfirmed,
-                is_rejected=v.isRejected,
-                booking_reason=convert_to_unicode(v.reason),
-                rejection_reason=convert_to_unicode(getattr(v, 'rejectionReason', None)),
+                id=v['id'],
+                room_id=v['room_id'],
+                created_dt=as_utc(v['created_dt']),
+                start_dt=utc_to_local(v['start_dt']),
+                end_dt=utc_to_local(v['end_dt']),
+                booked_for_id=self._get_user_id(v['booked_for_id']),
+                booked_for_name=convert_to_unicode(v['booked_for_name']),
+                created_by_id=self._get_user_id(v['created_by']),
+                is_cancelled=v['is_cancelled'],
+                is_accepted=v['is_confirmed'],
+                is_rejected=v['is_rejected'],
+                booking_reason=convert_to_unicode(v['reason']),
+                rejection_reason=convert_to_unicode(v['rejection_reason']),
                 repeat_frequency=repeat_frequency,
                 repeat_interval=repeat_interval,
-                uses_vc=getattr(v, 'usesAVC', False),
-                needs_vc_assistance=getattr(v, 'needsAVCSupport', False),
-                needs_assistance=getattr(v, 'needsAssistance', False)
+                uses_vc=v['uses_vc'],
+                needs_vc_assistance=v['needs_vc_assistance'],
+                needs_assistance=v['needs_assistance']
             )
 
-            for eq_name in getattr(v, 'useVC', []):
-                eq = room.location.get_equipment_by_name(eq_name)
+            for eq_name in v['used_vc']:
+                eq = equipment.get((location_id, eq_name))
                 if eq:
                     r.used_equipment.append(eq)
 
             occurrence_rejection_reasons = {}
-            if getattr(v, 'resvHistory', None):
-                for h in reversed(v.resvHistory._entries):
-                    ts = as_utc(parse_dt_string(h._timestamp))
-
-                    if len(h._info) == 2:
-                        possible_rejection_date, possible_rejection_reason = h._info
-                        m = re.match(r'Booking occurrence of the (\d{1,2} \w{3} \d{4}) rejected',
-                                     possible_rejection_reason)
-                        if m:
-                            d = datetime.strptime(m.group(1), '%d %b %Y')
-                            occurrence_rejection_reasons[d] = possible_rejection_reason[9:].strip('\'')
-
-                    el = ReservationEditLog(
-                        timestamp=ts,
-                        user_name=h._responsibleUser,
-                        info=map(convert_to_unicode, h._info)
-                    )
-                    r.edit_logs.append(el)
-
-            notifications = getattr(v, 'startEndNotification', []) or []
-            excluded_days = getattr(v, '_excludedDays', []) or []
-            ReservationOccurrence.create_series_for_reservation(r)
-            for occ in r.occurrences:
-                occ.notification_sent = occ.date in notifications
-                occ.is_rejected = r.is_rejected
-                occ.is_cancelled = r.is_cancelled or occ.date in excluded_days
-                occ.rejection_reason = (convert_to_unicode(occurrence_rejection_reasons[occ.date])
-                                        if occ.date in occurrence_rejection_reasons else None)
-
-            event_id = getattr(v, '_ReservationBase__owner', None)
-            if hasattr(event_id, '_Impersistant__obj'):  # Impersistant object
-                event_id = event_id._Impersistant__obj
-            if event_id is not None:
-                event = self.zodb_root['conferences'].get(event_id)
-                if event:
-                    # For some stupid reason there are bookings in the database which have a completely unrelated parent
-                    guids = getattr(event, '_Conference__roomBookingGuids', [])
-                    if any(int(x.id) == v.id for x in guids if x.id is not None):
-                        r.event_id = int(event_id)
-                    else:
-                        self.print_error('event {} does not contain booking {}'.format(event_id, v.id))
+            for h in v['history']:
+                ts = as_utc(parse_timestamp(h['timestamp']))
+
+                if len(h['info']) == 2:
+                    possible_rejection_date, possible_rejection_reason = h['info']
+                    m = OCCURRENCE_REJECTED_RE.match(possible_rejection_reason)
+                    if m:
+                        d = datetime.strptime(m.group(1), '%d %b %Y')
+                        occurrence_rejection_reasons[d] = possible_rejection_reason[9:].strip('\'')
+
+                el = ReservationEditLog(
+                    timestamp=ts,
+                    user_name=h['user'],
+                    info=map(convert_to_unicode, h['info'])
+                )
+                r.edit_logs.append(el)
+
+            self._add_occurrences(r, v, occurrence_rejection_reasons)
+
+            event_id = v['event_id']
+            # bookings of events which have not been migrated are not linked to any event
+            if event_id is not None and event_id in legacy_event_ids:
+                # For some stupid reason there are bookings in the database which have a completely unrelated parent
+                if v['id'] in event_booking_ids.get(event_id, ()):
+                    r.event_id = legacy_event_ids.get_id(event_id)
+                else:
+                    self.print_error('event {} does not contain booking {}'.format(event_id, v['id']))
 
             self.print_info('- [%[cyan]{}%[reset]/%[green!]{}%[reset]]  %[grey!]{}%[reset]  {}'.format(
-                room.location_name,
-                room.name,
+                location_name,
+                room_name,
                 r.id,
                 r.created_dt.date()))
 
-            i = (i + 1) % 1000
-            if not i:
-                db.session.commit()
-        db.session.commit()
-        self.fix_sequences('roombooking')
+            db.session.add(r)
+            count += 1
+        return count
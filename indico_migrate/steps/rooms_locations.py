@@ -19,6 +19,7 @@ from __future__ import unicode_literals
 import os
 from collections import defaultdict
 from itertools import ifilter
+from multiprocessing.pool import ThreadPool
 
 from indico.core.db import db
 from indico.modules.groups import GroupProxy
@@ -58,11 +59,31 @@ def get_room_id(guid):
     return int(guid.split('|')[1].strip())
 
 
+def _read_photo(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def get_equipment_map():
+    """Get all equipment types, keyed by their location id and name"""
+    equipment = {}
+    for eq in EquipmentType.query.order_by(EquipmentType.id):
+        equipment.setdefault((eq.location_id, eq.name), eq)
+    return equipment
+
+
 class RoomsLocationsImporter(TopLevelMigrationStep):
     step_name = 'rooms_locations'
+    requires = frozenset({'avatar_merged_user', 'all_groups', 'users.users'})
+    provides = frozenset({'room_mapping', 'venue_mapping', 'roombooking.locations', 'roombooking.rooms'})
+    isolated = True
 
     def __init__(self, *args, **kwargs):
         self.photo_path = kwargs.pop('photo_path')
+        self.photo_jobs = kwargs.pop('photo_jobs')
         self.rb_root = kwargs.get('rb_root')
         super(RoomsLocationsImporter, self).__init__(*args, **kwargs)
 
@@ -138,6 +159,32 @@ class RoomsLocationsImporter(TopLevelMigrationStep):
             db.session.add(location)
         db.session.flush()
 
+    def _load_photos(self, names):
+        """Read the photos of the rooms with the given canonical names.
+
+        The files are read by a pool of `photo_jobs` threads.
+
+        :return: a dict mapping canonical room names to ``(photo, thumbnail)``
+                 tuples
+        """
+        def _read(name):
+            filename = name + '.jpg'
+            return (name,
+                    _read_photo(os.path.join(self.photo_path, 'large_photos', filename)),
+                    _read_photo(os.path.join(self.photo_path, 'small_photos', filename)))
+
+        photos = {}
+        pool = ThreadPool(self.photo_jobs)
+        try:
+            for name, large_photo, small_photo in pool.imap_unordered(_read, names):
+                if large_photo and small_photo:
+                    photos[name] = (large_photo, small_photo)
+        finally:
+            pool.close()
+            pool.join()
+        self.print_info('%[blue!]Photos:%[reset] {} rooms'.format(len(photos)))
+        return photos
+
     @step_description('Rooms')
     def migrate_rooms(self):
         eq = defaultdict(set)
@@ -146,8 +193,9 @@ class RoomsLocationsImporter(TopLevelMigrationStep):
             eq[old_room._locationName].update(e for e in old_room._equipment.split('`') if e)
             vc[old_room._locationName].update(e for e in getattr(old_room, 'avaibleVC', []) if e)
 
+        locations = {loc.name: loc for loc in Location.query}
         for name, eqs in eq.iteritems():
-            location = Location.find_first(name=name)
+            location = locations.get(name)
 
             if location is None:
                 self.print_warning("Location '{}' does not exist. Skipped equipment: {}".format(name, eqs))
@@ -158,14 +206,15 @@ class RoomsLocationsImporter(TopLevelMigrationStep):
             db.session.add(location)
         db.session.flush()
 
+        equipment = get_equipment_map()
         for name, vcs in vc.iteritems():
-            location = Location.find_first(name=name)
+            location = locations.get(name)
 
             if location is None:
                 self.print_warning("Location '{}' does not exist. Skipped VC equipment: {}".format(name, vcs))
                 continue
 
-            pvc = location.get_equipment_by_name('Video conference')
+            pvc = equipment.get((location.id, 'Video conference'))
             for vc_name in vcs:
                 req = EquipmentType(name=vc_name)
                 req.parent = pvc
@@ -174,8 +223,14 @@ class RoomsLocationsImporter(TopLevelMigrationStep):
             db.session.add(location)
         db.session.flush()
 
+        photos = {}
+        if self.photo_path:
+            photos = self._load_photos({get_canonical_name_of(old_room)
+                                        for old_room in self.rb_root['Rooms'].itervalues()})
+
+        equipment = get_equipment_map()
         for old_room_id, old_room in self.rb_root['Rooms'].iteritems():
-            location = Location.find_first(name=old_room._locationName)
+            location = locations.get(old_room._locationName)
 
             if location is None:
                 self.print_warning("Location '{}' does not exist. Skipped room '{}'".format(old_room._locationName,
@@ -238,28 +293,15 @@ class RoomsLocationsImporter(TopLevelMigrationStep):
                 )
                 self.print_info('  %[blue!]Nonbookable:%[reset] {}'.format(r.nonbookable_periods[-1]))
 
-            if self.photo_path:
-                try:
-                    with open(os.path.join(self.photo_path, 'large_photos',
-                                           get_canonical_name_of(old_room) + '.jpg'), 'rb') as f:
-                        large_photo = f.read()
-                except Exception:
-                    large_photo = None
-
-                try:
-                    with open(os.path.join(self.photo_path, 'small_photos',
-                                           get_canonical_name_of(old_room) + '.jpg'), 'rb') as f:
-                        small_photo = f.read()
-                except Exception:
-                    small_photo = None
-
-                if large_photo and small_photo:
-                    r.photo = Photo(data=large_photo, thumbnail=small_photo)
-                    self.print_info('  %[blue!]Photos')
+            photo = photos.get(get_canonical_name_of(old_room))
+            if photo:
+                large_photo, small_photo = photo
+                r.photo = Photo(data=large_photo, thumbnail=small_photo)
+                self.print_info('  %[blue!]Photos')
 
             new_eq = []
             for old_equipment in ifilter(None, old_room._equipment.split('`') + old_room.avaibleVC):
-                room_eq = location.get_equipment_by_name(old_equipment)
+                room_eq = equipment.get((location.id, old_equipment))
                 new_eq.append(room_eq)
                 r.available_equipment.append(room_eq)
             if new_eq:
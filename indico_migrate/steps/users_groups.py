@@ -16,9 +16,11 @@
 
 from __future__ import unicode_literals
 
+import time
 from collections import defaultdict
 from datetime import timedelta
-from operator import attrgetter
+from itertools import count
+from operator import attrgetter, itemgetter
 from uuid import uuid4
 
 import pytz
@@ -30,6 +32,8 @@ from indico.modules.api import APIKey
 from indico.modules.auth import Identity
 from indico.modules.groups.models.groups import LocalGroup
 from indico.modules.users import User, user_settings
+from indico.modules.users.models.emails import UserEmail
+from indico.modules.users.models.settings import UserSetting
 from indico.modules.users.models.users import UserTitle
 from indico.util.caching import memoize
 from indico.util.i18n import get_all_locales
@@ -37,7 +41,8 @@ from indico.util.string import is_valid_mail, sanitize_email
 from indico.util.struct.iterables import committing_iterator
 
 from indico_migrate.importer import TopLevelMigrationStep
-from indico_migrate.util import convert_to_unicode, step_description
+from indico_migrate.records import avatar_record
+from indico_migrate.util import DisjointSet, convert_to_unicode, get_identity, step_description
 
 
 USER_TITLE_MAP = {x.title: x for x in UserTitle}
@@ -50,6 +55,24 @@ SYNCED_FIELD_MAP = {
 }
 
 
+class _UserEmails(object):
+    """The emails of a user while resolving collisions"""
+
+    __slots__ = ('user_id', 'email', 'secondary_emails', 'is_deleted', 'has_identities', 'existing', 'changed')
+
+    def __init__(self, user_id, email, secondary_emails, is_deleted, has_identities, existing=False):
+        self.user_id = user_id
+        self.email = email
+        self.secondary_emails = secondary_emails
+        self.is_deleted = is_deleted
+        self.has_identities = has_identities
+        self.existing = existing
+        self.changed = False
+
+    def __repr__(self):
+        return '<User({}, {})>'.format(self.user_id, self.email)
+
+
 @memoize
 def _get_all_locales():
     return set(get_all_locales())
@@ -57,6 +80,10 @@ def _get_all_locales():
 
 class UserImporter(TopLevelMigrationStep):
     step_name = 'users'
+    extract_domain = 'users'
+    supports_delta = True
+    provides = frozenset({'avatar_merged_user', 'all_groups', 'user_favorite_categories', 'users_by_primary_email',
+                          'users_by_secondary_email', 'users_by_email', 'users.users', 'users.groups'})
 
     def __init__(self, *args, **kwargs):
         self.ldap_provider_name = kwargs.pop('ldap_provider_name')
@@ -65,22 +92,25 @@ class UserImporter(TopLevelMigrationStep):
         super(UserImporter, self).__init__(*args, **kwargs)
 
     def migrate(self):
-        self.unresolved_merge_targets = defaultdict(set)
         self.favorite_avatars = {}
         self.migrate_users()
-        self.fix_sequences('users', {'users'})
+        self.fix_sequences('users', {'users', 'emails', 'identities', 'api_keys', 'settings'})
         self.migrate_favorite_users()
-        self.migrate_admins()
-        if 'groups' in self.zodb_root:
-            self.migrate_groups()
-        self.fix_sequences('users', {'groups'})
-        self.migrate_system_user()
-        self.global_ns.users_by_email = dict(self.global_ns.users_by_primary_email)
+        if self.delta is None:
+            self.migrate_admins()
+            if 'groups' in self.zodb_root:
+                self.migrate_groups()
+            self.fix_sequences('users', {'groups'})
+            self.migrate_system_user()
+        self.global_ns.users_by_email.clear()
+        self.global_ns.users_by_email.update(self.global_ns.users_by_primary_email)
         self.global_ns.users_by_email.update(self.global_ns.users_by_secondary_email)
         # delete identities of deleted users. they should not have any since otherwise
         # a login using a remote provider fails instead of creating a new user for them
         Identity.query.filter(Identity.user.has(is_deleted=True)).delete(synchronize_session=False)
         db.session.commit()
+        # principals converted so far may not have been resolved to the migrated users
+        self.clear_principal_cache()
 
     def migrate_system_user(self):
         if self.system_user_id is not None:
@@ -97,136 +127,233 @@ class UserImporter(TopLevelMigrationStep):
 
     @step_description('Users')
     def migrate_users(self):
-        seen_identities = set()
-
-        for avatar in committing_iterator(self._iter_avatars(), 5000):
-            if getattr(avatar, '_mergeTo', None):
-                self.print_warning('Skipping {} - merged into {}'.format(avatar.id, avatar._mergeTo.id))
-                merged_user = self.global_ns.avatar_merged_user.get(avatar._mergeTo.id)
-                if merged_user:
-                    self.global_ns.avatar_merged_user[avatar.id] = merged_user
-                else:
-                    # if the merge target hasn't yet been migrated, keep track of it
-                    self.unresolved_merge_targets[avatar._mergeTo.id].add(avatar.id)
-                continue
-            elif avatar.status == 'Not confirmed':
-                self.print_warning('Skipping {} - not activated'.format(avatar.id))
+        start = time.time()
+        it, total = self._iter_avatars()
+        if self.quiet:
+            it = self.logger.progress_iterator('Reading users', it, total, itemgetter('id'), lambda x: '')
+        avatars = self._resolve_collisions(it)
+        self.print_info('%[cyan]{}%[reset] avatars checked for collisions in {:.02f}s'
+                        .format(len(avatars), time.time() - start), always=True)
+
+        start = time.time()
+        self._id_counters = {model: count((db.session.query(db.func.max(model.id)).scalar() or 0) + 1)
+                             for model in (UserEmail, Identity, APIKey)}
+        it = iter(avatars)
+        if self.quiet:
+            it = self.logger.progress_iterator('Migrating users', it, len(avatars), lambda x: x[0]['id'],
+                                               lambda x: '')
+        self._pending_settings = []
+        for avatar, emails, identities in self.batch_committing_iterator(it, UserSetting.__table__,
+                                                                         self._pending_settings, 5000):
+            if emails is None:
+                self._update_user(self.global_ns.avatar_merged_user[avatar['id']], avatar)
                 continue
-            elif not avatar.name.strip() and not avatar.surName.strip():
-                links = {(obj, role): list(objs)
-                         for obj, x in avatar.linkedTo.iteritems()
-                         for role, objs in x.iteritems()
-                         if objs}
-                if not avatar.identities and not links:
-                    self.print_warning('Skipping {} - no names and no identities/links'.format(avatar.id))
-                    continue
 
-            user = self._user_from_avatar(avatar)
-            self._fix_collisions(user, avatar)
+            user = self._user_from_avatar(avatar, emails)
             db.session.add(user)
-            settings = self._settings_from_avatar(avatar)
-            user_settings.set_multi(user, settings)
+            self._add_settings(user, self._settings_from_avatar(avatar))
             # favorite users cannot be migrated here since the target user might not have been migrated yet
-            for old_categ in avatar.linkedTo['category']['favorite']:
-                if old_categ:
-                    self.global_ns.user_favorite_categories[old_categ.id].add(user)
-            db.session.flush()
+            for old_categ_id in avatar['favorite_categories']:
+                self.global_ns.user_favorite_categories[old_categ_id].add(user)
             self.print_success('%[white!]{:6d}%[reset] %[cyan]{}%[reset] [%[blue!]{}%[reset]] '
                                '{{%[cyan!]{}%[reset]}}'.format(user.id, user.full_name, user.email,
                                                                ', '.join(user.secondary_emails)))
             # migrate API keys
             self._migrate_api_keys(avatar, user)
             # migrate identities of avatars
-            for old_identity in avatar.identities:
-                identity = None
-                username = convert_to_unicode(old_identity.login).strip().lower()
-
-                if not username:
-                    self.print_warning("Empty username: {}. Skipping identity.".format(old_identity))
+            for identity_data in identities:
+                identity = Identity(id=next(self._id_counters[Identity]), **identity_data)
+                self.print_info('%[blue!]<->%[reset]  %[yellow]{}%[reset]'.format(identity))
+                user.identities.add(identity)
+
+            if avatar['favorite_users']:
+                self.favorite_avatars[user.id] = avatar['favorite_users']
+
+            self.global_ns.avatar_merged_user[avatar['id']] = user
+        self._resolve_merged_avatars()
+        self._apply_email_changes()
+        self.print_info('%[cyan]{}%[reset] avatars migrated in {:.02f}s'.format(len(avatars), time.time() - start),
+                        always=True)
+
+    def _add_settings(self, user, settings):
+        """Queue the settings of a new user to be written with the current batch"""
+        self._pending_settings.extend({'user_id': user.id, 'module': user_settings.module, 'name': name,
+                                       'value': value}
+                                      for name, value in settings.iteritems())
+
+    def _resolve_collisions(self, avatars):
+        """Resolve email collisions between the avatars to migrate.
+
+        This runs over all avatars before any user is created, so the users
+        can be created with their final emails right away instead of
+        modifying (and flushing) them whenever a collision is found.
+
+        :return: a list of ``(avatar, emails, identities)`` tuples for the
+                 avatars to process; `emails` is ``None`` for users which
+                 only need to be updated (delta migrations)
+        """
+        self._email_states = {}
+        self._primary_emails = {}
+        self._secondary_emails = {}
+        for email, user in self.global_ns.users_by_primary_email.iteritems():
+            self._primary_emails[email] = self._get_email_state(user)
+        for email, user in self.global_ns.users_by_secondary_email.iteritems():
+            self._secondary_emails[email] = self._get_email_state(user)
+        seen_identities = set()
+        if self.delta is not None:
+            seen_identities = set(db.session.query(Identity.provider, Identity.identifier))
+
+        # merged avatars are resolved once all users exist; until then we only
+        # keep track of which avatars end up being the same user
+        self.merged_avatars = DisjointSet()
+        result = []
+        for avatar in avatars:
+            if avatar['merge_to']:
+                self.print_warning('Skipping {} - merged into {}'.format(avatar['id'], avatar['merge_to']))
+                self.merged_avatars.union(avatar['id'], avatar['merge_to'])
+                continue
+            elif avatar['status'] == 'Not confirmed':
+                self.print_warning('Skipping {} - not activated'.format(avatar['id']))
+                continue
+            elif avatar['has_links'] is not None:
+                # the avatar has no names
+                if not avatar['identities'] and not avatar['has_links']:
+                    self.print_warning('Skipping {} - no names and no identities/links'.format(avatar['id']))
                     continue
 
-                provider = {
-                    'LocalIdentity': 'indico',
-                    'LDAPIdentity': self.ldap_provider_name
-                }.get(old_identity.__class__.__name__)
+            # old merged avatars (no longer in AvatarHolder)
+            for merged_avatar_id in avatar['merge_from']:
+                if merged_avatar_id != avatar['id']:
+                    self.merged_avatars.union(merged_avatar_id, avatar['id'])
 
-                if provider is None:
-                    self.print_error("Unsupported provider: {}. Skipping identity.".format(
-                        old_identity.__class__.__name__))
+            if self.delta is not None:
+                existing = self.global_ns.avatar_merged_user.get(avatar['id'])
+                if existing is not None and existing.id == int(avatar['id']):
+                    result.append((avatar, None, None))
                     continue
 
-                if (provider, username) in seen_identities:
-                    self.print_error("Duplicate identity: {}, {}. Skipping.".format(provider, username))
-                    continue
+            emails = self._email_state_from_avatar(avatar)
+            self._fix_collisions(emails, avatar)
+            identities = list(self._identities_from_avatar(avatar, seen_identities))
+            emails.has_identities = bool(identities)
+            result.append((avatar, emails, identities))
+        return result
+
+    def _get_email_state(self, user):
+        user_id = get_identity(user)
+        try:
+            return self._email_states[user_id]
+        except KeyError:
+            state = self._email_states[user_id] = _UserEmails(user_id, user.email, set(user.secondary_emails),
+                                                              user.is_deleted, bool(user.identities), existing=True)
+            return state
+
+    def _email_state_from_avatar(self, avatar):
+        email = sanitize_email(convert_to_unicode(avatar['email']).lower().strip())
+        secondary_emails = {sanitize_email(convert_to_unicode(x).lower().strip()) for x in avatar['secondary_emails']}
+        secondary_emails = {x for x in secondary_emails if x and is_valid_mail(x, False) and x != email}
+        state = _UserEmails(int(avatar['id']), email, secondary_emails, not is_valid_mail(email), False)
+        self._email_states[state.user_id] = state
+        return state
 
-                if provider == 'indico' and not self.ignore_local_accounts:
-                    identity = Identity(provider=provider, identifier=username)
-
-                    if not hasattr(old_identity, 'algorithm'):  # plaintext password
-                        if not old_identity.password:
-                            # password is empty, skip identity
-                            self.print_error("Identity '{}' has empty password. Skipping identity.".format(
-                                              old_identity.login))
-                            continue
-                        identity.password = old_identity.password
-                    else:
-                        assert old_identity.algorithm == 'bcrypt'
-                        identity.password_hash = old_identity.password
-
-                elif provider == self.ldap_provider_name:
-                    identity = Identity(provider=provider, identifier=username)
-
-                if identity:
-                    self.print_info('%[blue!]<->%[reset]  %[yellow]{}%[reset]'.format(identity))
-                    user.identities.add(identity)
-                    seen_identities.add((provider, username))
-
-            if hasattr(avatar, 'personalInfo') and avatar.personalInfo._basket._users:
-                self.favorite_avatars[user.id] = avatar.personalInfo._basket._users
-
-            # Map old merged identities (no longer in AvatarHolder)
-            # to newly created user
-            for merged_avatar in getattr(avatar, '_mergeFrom', ()):
-                if merged_avatar.id != avatar.id:
-                    self.global_ns.avatar_merged_user[merged_avatar.id] = user
-
-            self.global_ns.avatar_merged_user[avatar.id] = user
-            if avatar.id in self.unresolved_merge_targets:
-                del self.unresolved_merge_targets[avatar.id]
-                self._resolve_merge_targets(avatar.id, user)
-        db.session.flush()
+    def _identities_from_avatar(self, avatar, seen_identities):
+        for old_identity in avatar['identities']:
+            username = convert_to_unicode(old_identity['login']).strip().lower()
+
+            if not username:
+                self.print_warning("Empty username: {}. Skipping identity.".format(old_identity['login']))
+                continue
+
+            provider = {
+                'LocalIdentity': 'indico',
+                'LDAPIdentity': self.ldap_provider_name
+            }.get(old_identity['type'])
+
+            if provider is None:
+                self.print_error("Unsupported provider: {}. Skipping identity.".format(old_identity['type']))
+                continue
+
+            if (provider, username) in seen_identities:
+                self.print_error("Duplicate identity: {}, {}. Skipping.".format(provider, username))
+                continue
 
-    def _resolve_merge_targets(self, avatar_id, user):
-        for source_av, target_av in self.unresolved_merge_targets.items():
-            if target_av == avatar_id:
-                self.global_ns.avatar_merged_user[source_av] = user
-                del self.unresolved_merge_targets[source_av]
-                self._resolve_merge_targets(source_av, user)
+            if provider == 'indico' and not self.ignore_local_accounts:
+                identity = {'provider': provider, 'identifier': username}
+
+                if old_identity['algorithm'] is None:  # plaintext password
+                    if not old_identity['password']:
+                        # password is empty, skip identity
+                        self.print_error("Identity '{}' has empty password. Skipping identity.".format(
+                                          old_identity['login']))
+                        continue
+                    identity['password'] = old_identity['password']
+                else:
+                    assert old_identity['algorithm'] == 'bcrypt'
+                    identity['password_hash'] = old_identity['password']
+
+            elif provider == self.ldap_provider_name:
+                identity = {'provider': provider, 'identifier': username}
+
+            else:
+                continue
+
+            seen_identities.add((provider, username))
+            yield identity
+
+    def _update_user(self, user, avatar):
+        """Update a user migrated by a previous run with the current data of the avatar"""
+        for key, value in self._profile_from_avatar(avatar).iteritems():
+            setattr(user, key, value)
+        user_settings.set_multi(user, self._settings_from_avatar(avatar))
+        self.print_success('%[white!]{:6d}%[reset] %[cyan]{}%[reset] (updated)'.format(user.id, user.full_name))
+
+    def _resolve_merged_avatars(self):
+        """Map merged avatars to the user of the avatar they have (possibly indirectly) been merged into"""
+        unresolved = defaultdict(list)
+        for avatar_id in self.merged_avatars:
+            target_id = self.merged_avatars.find(avatar_id)
+            if target_id == avatar_id:
+                continue
+            user_id = self.global_ns.avatar_merged_user.get_id(target_id)
+            if user_id is None:
+                unresolved[target_id].append(avatar_id)
+                continue
+            existing_id = self.global_ns.avatar_merged_user.get_id(avatar_id)
+            # avatars that have their own user keep it
+            if existing_id is None or existing_id != int(avatar_id):
+                self.global_ns.avatar_merged_user.set_id(avatar_id, user_id)
+        if unresolved:
+            self.print_warning('%[yellow!]{} merged avatars could not be resolved'
+                               .format(sum(len(x) for x in unresolved.itervalues())), always=True)
+            for target_id, avatar_ids in sorted(unresolved.iteritems()):
+                self.print_warning('Merge target {} has not been migrated: {}'.format(target_id,
+                                                                                     ', '.join(sorted(avatar_ids))))
 
     def _migrate_api_keys(self, avatar, user):
-        ak = getattr(avatar, 'apiKey', None)
+        ak = avatar['api_key']
         if not ak:
             return
         last_used_uri = None
-        if ak._lastPath and ak._lastQuery:
-            last_used_uri = '{}?{}'.format(convert_to_unicode(ak._lastPath), convert_to_unicode(ak._lastQuery))
-        elif ak._lastPath:
-            last_used_uri = convert_to_unicode(ak._lastPath)
-
-        api_key = APIKey(token=ak._key, secret=ak._signKey, is_blocked=ak._isBlocked,
-                         is_persistent_allowed=getattr(ak, '_persistentAllowed', False),
-                         created_dt=self._to_utc(ak._createdDT), last_used_dt=self._to_utc(ak._lastUsedDT),
-                         last_used_ip=ak._lastUsedIP, last_used_uri=last_used_uri,
-                         last_used_auth=ak._lastUseAuthenticated, use_count=ak._useCount)
+        if ak['last_path'] and ak['last_query']:
+            last_used_uri = '{}?{}'.format(convert_to_unicode(ak['last_path']), convert_to_unicode(ak['last_query']))
+        elif ak['last_path']:
+            last_used_uri = convert_to_unicode(ak['last_path'])
+
+        api_key = APIKey(id=next(self._id_counters[APIKey]), token=ak['key'], secret=ak['sign_key'],
+                         is_blocked=ak['is_blocked'],
+                         is_persistent_allowed=ak['persistent_allowed'],
+                         created_dt=self._to_utc(ak['created_dt']), last_used_dt=self._to_utc(ak['last_used_dt']),
+                         last_used_ip=ak['last_used_ip'], last_used_uri=last_used_uri,
+                         last_used_auth=ak['last_use_authenticated'], use_count=ak['use_count'])
         user.api_key = api_key
         self.print_info('%[blue!]<->%[reset]  %[yellow]{}%[reset]'.format(api_key))
 
-        for old_key in ak._oldKeys:
+        for old_key in ak['old_keys']:
             # We have no creation time so we use *something* older..
-            fake_created_dt = self._to_utc(ak._createdDT) - timedelta(hours=1)
+            fake_created_dt = self._to_utc(ak['created_dt']) - timedelta(hours=1)
             # We don't have anything besides the api key for old keys, so we use a random secret
-            user.old_api_keys.append(APIKey(token=old_key, secret=unicode(uuid4()), created_dt=fake_created_dt,
-                                            is_active=False))
+            user.old_api_keys.append(APIKey(id=next(self._id_counters[APIKey]), token=old_key,
+                                            secret=unicode(uuid4()), created_dt=fake_created_dt, is_active=False))
 
     @step_description('Favorite users')
     def migrate_favorite_users(self):
@@ -294,49 +421,50 @@ class UserImporter(TopLevelMigrationStep):
             db.session.add(group)
         db.session.flush()
 
-    def _user_from_avatar(self, avatar, **kwargs):
-        email = sanitize_email(convert_to_unicode(avatar.email).lower().strip())
-        secondary_emails = {sanitize_email(convert_to_unicode(x).lower().strip()) for x in avatar.secondaryEmails}
-        secondary_emails = {x for x in secondary_emails if x and is_valid_mail(x, False) and x != email}
+    def _user_from_avatar(self, avatar, emails, **kwargs):
+        kwargs.update(self._profile_from_avatar(avatar))
         # we handle deletion later. otherwise it might be set before secondary_emails which would
         # result in those emails not being marked as deleted
-        user = User(id=int(avatar.id),
-                    email=email,
-                    first_name=convert_to_unicode(avatar.name).strip() or 'UNKNOWN',
-                    last_name=convert_to_unicode(avatar.surName).strip() or 'UNKNOWN',
-                    title=USER_TITLE_MAP.get(avatar.title, UserTitle.none),
-                    phone=convert_to_unicode(avatar.telephone[0]).strip(),
-                    affiliation=convert_to_unicode(avatar.organisation[0]).strip(),
-                    address=convert_to_unicode(avatar.address[0]).strip(),
-                    secondary_emails=secondary_emails,
-                    is_blocked=avatar.status == 'disabled',
+        user = User(id=emails.user_id,
+                    email=emails.email,
+                    secondary_emails=emails.secondary_emails,
                     is_deleted=False,
                     **kwargs)
-        if not is_valid_mail(user.email):
+        if emails.is_deleted:
             user.is_deleted = True
+        # explicit ids allow inserting the emails in batches
+        for user_email in [user._primary_email] + list(user._secondary_emails):
+            user_email.id = next(self._id_counters[UserEmail])
         return user
 
+    def _profile_from_avatar(self, avatar):
+        return {
+            'first_name': convert_to_unicode(avatar['name']).strip() or 'UNKNOWN',
+            'last_name': convert_to_unicode(avatar['surname']).strip() or 'UNKNOWN',
+            'title': USER_TITLE_MAP.get(avatar['title'], UserTitle.none),
+            'phone': convert_to_unicode(avatar['phone']).strip(),
+            'affiliation': convert_to_unicode(avatar['affiliation']).strip(),
+            'address': convert_to_unicode(avatar['address']).strip(),
+            'is_blocked': avatar['status'] == 'disabled'
+        }
+
     def _settings_from_avatar(self, avatar):
-        timezone = avatar.timezone
+        timezone = avatar['timezone']
         if not timezone or timezone not in all_timezones_set:
             timezone = getattr(self.zodb_root['MaKaCInfo']['main'], '_timezone', 'UTC')
-        language = avatar._lang
+        language = avatar['lang']
 
         if language not in _get_all_locales():
             language = getattr(self.zodb_root['MaKaCInfo']['main'], '_lang', 'en_GB')
-        show_past_events = False
-
-        if hasattr(avatar, 'personalInfo'):
-            show_past_events = bool(getattr(avatar.personalInfo, '_showPastEvents', False))
 
         settings = {
             'lang': language,
             'timezone': timezone,
-            'force_timezone': avatar.displayTZMode == 'MyTimezone',
-            'show_past_events': show_past_events,
+            'force_timezone': avatar['display_tz_mode'] == 'MyTimezone',
+            'show_past_events': avatar['show_past_events'],
         }
 
-        unlocked_fields = {SYNCED_FIELD_MAP.get(field) for field in getattr(avatar, 'unlockedFields', [])} - {None}
+        unlocked_fields = {SYNCED_FIELD_MAP.get(field) for field in avatar['unlocked_fields']} - {None}
         if unlocked_fields:
             settings['synced_fields'] = list(set(SYNCED_FIELD_MAP.viewvalues()) - unlocked_fields)
 
@@ -345,51 +473,64 @@ class UserImporter(TopLevelMigrationStep):
     def _fix_collisions(self, user, avatar):
         is_deleted = user.is_deleted
         # Mark both users as deleted if there's a primary email collision
-        coll = self.global_ns.users_by_primary_email.get(user.email)
+        coll = self._primary_emails.get(user.email)
         if coll and not is_deleted:
-            if bool(avatar.identities) ^ bool(coll.identities):
+            if bool(avatar['identities']) ^ coll.has_identities:
                 # exactly one of them has identities - keep the one that does
-                to_delete = {coll if avatar.identities else user}
+                to_delete = {coll if avatar['identities'] else user}
             else:
                 to_delete = {user, coll}
             for u in to_delete:
                 self.print_log('%[magenta!]---%[reset] %[yellow!]Deleting {} - primary email collision%[reset] '
-                               '[%[blue!]{}%[reset]]'.format(u.id, u.email))
+                               '[%[blue!]{}%[reset]]'.format(u.user_id, u.email))
                 u.is_deleted = True
-                db.session.flush()
+                u.changed = True
         # if the user was already deleted we don't care about primary email collisions
         if not is_deleted:
-            self.global_ns.users_by_primary_email[user.email] = user
+            self._primary_emails[user.email] = user
 
         # Remove primary email from another user's secondary email list
-        coll = self.global_ns.users_by_secondary_email.get(user.email)
-        if coll and user.merged_into_id != coll.id:
+        coll = self._secondary_emails.get(user.email)
+        if coll:
             self.print_log('%[magenta!]---%[reset] %[yellow!]1 Removing colliding secondary email (P/S from {}%[reset] '
                            '[%[blue!]{}%[reset]])'.format(coll, user.email))
-            coll.secondary_emails.remove(user.email)
-            del self.global_ns.users_by_secondary_email[user.email]
-            db.session.flush()
+            coll.secondary_emails.discard(user.email)
+            coll.changed = True
+            del self._secondary_emails[user.email]
 
         # Remove email from both users if there's a collision
         for email in list(user.secondary_emails):
             # colliding with primary email
-            coll = self.global_ns.users_by_primary_email.get(email)
+            coll = self._primary_emails.get(email)
             if coll:
                 self.print_log('%[magenta!]---%[reset] %[yellow!]Removing colliding secondary email '
                                '(S/P from {}%[reset] [%[blue!]{}%[reset]])'.format(user, email))
-                user.secondary_emails.remove(email)
-                db.session.flush()
+                user.secondary_emails.discard(email)
             # colliding with a secondary email
-            coll = self.global_ns.users_by_secondary_email.get(email)
+            coll = self._secondary_emails.get(email)
             if coll:
                 self.print_log('%[magenta!]---%[reset] %[yellow!]Removing colliding secondary email '
                                '(S/S from {}%[reset] [%[blue!]{}%[reset]])'.format(user, email))
-                user.secondary_emails.remove(email)
-                db.session.flush()
-                self.global_ns.users_by_secondary_email[email] = coll
+                user.secondary_emails.discard(email)
+                self._secondary_emails[email] = coll
             # if the user was already deleted we don't care about secondary email collisions
             if not is_deleted and email in user.secondary_emails:
-                self.global_ns.users_by_secondary_email[email] = user
+                self._secondary_emails[email] = user
+
+    def _apply_email_changes(self):
+        """Apply the results of the collision resolution to already existing users and the email maps"""
+        for state in self._email_states.itervalues():
+            if state.existing and state.changed:
+                user = User.get(state.user_id)
+                user.secondary_emails = state.secondary_emails
+                user.is_deleted = state.is_deleted
+        self.global_ns.users_by_primary_email.clear()
+        for email, state in self._primary_emails.iteritems():
+            self.global_ns.users_by_primary_email.set_id(email, state.user_id)
+        self.global_ns.users_by_secondary_email.clear()
+        for email, state in self._secondary_emails.iteritems():
+            self.global_ns.users_by_secondary_email.set_id(email, state.user_id)
+        del self._email_states, self._primary_emails, self._secondary_emails
 
     def _to_utc(self, dt):
         if dt is None:
@@ -398,8 +539,8 @@ class UserImporter(TopLevelMigrationStep):
         return server_tz.localize(dt).astimezone(pytz.utc)
 
     def _iter_avatars(self):
-        it = self.zodb_root['avatars'].itervalues()
-        if self.quiet:
-            it = self.logger.progress_iterator('Migrating users', it, len(self.zodb_root['avatars']), attrgetter('id'),
-                                               lambda x: '')
-        return it
+        if self.delta is not None:
+            avatars = self.zodb_root['avatars']
+            keys = sorted(self.delta.affected('avatars'))
+            return (avatar_record(avatars[key]) for key in keys), len(keys)
+        return self.iter_records(self.zodb_root['avatars'], avatar_record)
@@ -21,15 +21,18 @@ import hashlib
 import os
 import re
 import sys
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import timedelta
-from functools import wraps
+from functools import update_wrapper, wraps
 from HTMLParser import HTMLParser
+from threading import Lock
 from urlparse import urlparse
 from uuid import uuid4
 
 import click
 import yaml
+from sqlalchemy import inspect
 from colorclass import Color
 from termcolor import colored
 from ZEO.ClientStorage import ClientStorage
@@ -37,7 +40,6 @@ from ZODB import DB, FileStorage
 from ZODB.broken import Broken, find_global
 
 from indico.core.auth import IndicoMultipass
-from indico.util.caching import memoize
 from indico.util.date_time import now_utc
 from indico.util.string import sanitize_email, strip_tags
 
@@ -86,7 +88,7 @@ class UnbreakingDB(DB):
         return find_global(modulename, globalname, Broken=NotBroken)
 
 
-def get_storage(zodb_uri):
+def get_storage(zodb_uri, read_only=False):
     uri_parts = urlparse(str(zodb_uri))
 
     print cformat2("%[green]Trying to open {}...").format(zodb_uri)
@@ -98,22 +100,106 @@ def get_storage(zodb_uri):
         storage = ClientStorage((uri_parts.hostname, uri_parts.port or 9675),
                                 username=uri_parts.username,
                                 password=uri_parts.password,
-                                realm=uri_parts.path[1:])
+                                realm=uri_parts.path[1:],
+                                read_only=read_only)
 
     elif uri_parts.scheme in ('file', None):
-        storage = FileStorage.FileStorage(uri_parts.path)
+        storage = FileStorage.FileStorage(uri_parts.path, read_only=read_only)
     else:
         raise Exception("URI scheme not known: {}".format(uri_parts.scheme))
     print cformat2("%[green]Done!")
     return storage
 
 
-def convert_to_unicode(val, strip=True, _control_char_re=re.compile(ur'[\x00-\x08\x0b-\x0c\x0e-\x1f]')):
+def get_identity(obj):
+    """Get the primary key of an object without loading it from the database"""
+    return inspect(obj).identity[0]
+
+
+def partition_keys(tree, partitions):
+    """Split the keys of a BTree into consecutive ``(min, max)`` ranges"""
+    keys = list(tree.keys())
+    size = max(1, -(-len(keys) // partitions))
+    return [(keys[i], keys[min(i + size, len(keys)) - 1]) for i in xrange(0, len(keys), size)]
+
+
+def get_event_subset(zodb_root, event_ids=(), category_id=None):
+    """Get the ids of the legacy conferences to migrate.
+
+    :param event_ids: Legacy ids of conferences to migrate
+    :param category_id: Legacy id of a category; all conferences in its
+                        subtree are migrated
+    """
+    subset = set(event_ids)
+    if category_id is not None:
+        stack = [zodb_root['categories'][category_id]]
+        while stack:
+            categ = stack.pop()
+            stack.extend(categ.subcategories.itervalues())
+            confs = categ.conferences
+            subset.update(conf.id for conf in (confs.itervalues() if hasattr(confs, 'itervalues') else confs))
+    return frozenset(subset)
+
+
+#: The bytes `convert_to_unicode` needs to replace or remove, i.e. tabs
+#: and all control chars except newlines
+_UNICODE_SPECIAL_BYTES = b''.join(chr(c) for c in xrange(0x20) if c not in (0x0a, 0x0d))
+_CONTROL_CHAR_RE = re.compile(ur'[\x00-\x08\x0b-\x0c\x0e-\x1f]')
+#: The cached unicode versions of short byte strings, for each value of
+#: `strip` a list of the current and the previous generation
+_unicode_cache = {True: [{}, {}], False: [{}, {}]}
+_unicode_cache_size = 0
+
+
+def set_unicode_cache_size(size):
+    """Set the number of byte strings whose unicode conversion is cached.
+
+    Values such as affiliations, titles or location names repeat a lot,
+    so the converted versions of recently used short strings are kept.
+    Once `size` strings have been cached, they become the previous
+    generation and a new one is started; strings found in the previous
+    generation are moved to the new one.  This keeps strings that are
+    used again and again, like an LRU cache, while one-off strings (e.g.
+    the names of the users) are dropped.  A size of 0 disables the cache.
+    """
+    global _unicode_cache_size
+    for generations in _unicode_cache.itervalues():
+        generations[:] = [{}, {}]
+    _unicode_cache_size = size
+
+
+def _convert_str_to_unicode(val, strip):
+    try:
+        rv = unicode(val, 'utf-8')
+    except UnicodeError:
+        rv = unicode(val, 'latin1')
+    # neither utf-8 nor latin1 produce control chars unless they are present as
+    # plain bytes, so most strings do not need to go through the regex
+    if len(val.translate(None, _UNICODE_SPECIAL_BYTES)) != len(val):
+        rv = _CONTROL_CHAR_RE.sub(u'', rv.replace(u'\t', u' ' * 4))
+    if strip:
+        rv = rv.strip()
+    return rv
+
+
+def convert_to_unicode(val, strip=True, _control_char_re=_CONTROL_CHAR_RE):
     if isinstance(val, str):
-        try:
-            rv = unicode(val, 'utf-8')
-        except UnicodeError:
-            rv = unicode(val, 'latin1')
+        if not _unicode_cache_size or len(val) > 256:
+            return _convert_str_to_unicode(val, strip)
+        # a plain dict is a lot faster than a real LRU cache, which would
+        # often take longer than converting the string again
+        generations = _unicode_cache[bool(strip)]
+        current = generations[0]
+        rv = current.get(val)
+        if rv is None:
+            rv = generations[1].get(val)
+            if rv is None:
+                rv = _convert_str_to_unicode(val, strip)
+            if len(current) >= _unicode_cache_size:
+                current = {}
+                generations[:] = [current, generations[0]]
+            current[val] = rv
+        return rv
     elif isinstance(val, unicode):
         rv = val
     elif isinstance(val, int):
@@ -189,6 +275,49 @@ def get_file_md5(path, chunk_size=1024*1024):
     return unicode(checksum.hexdigest())
 
 
+def find_local_file(archive_dirs, resource):
+    """Find the file of a legacy LocalFile resource in the archive.
+
+    Paths containing non-ASCII characters are often stored using a
+    different encoding than the one used on disk, so several encodings
+    are tried.
+
+    :return: an ``(archive_path, path)`` tuple or ``(None, None)`` if such
+             a path cannot be resolved
+    """
+    archive_id = resource._LocalFile__archivedId
+    repo_path = resource._LocalFile__repository._MaterialLocalRepository__files[archive_id]
+    for archive_path in map(bytes, archive_dirs):
+        path = os.path.join(archive_path, repo_path)
+        if any(ord(c) > 127 for c in repo_path):
+            foobar = (('strict', 'iso-8859-1'), ('replace', sys.getfilesystemencoding()), ('replace', 'ascii'))
+            for mode, enc in foobar:
+                try:
+                    dec_path = path.decode('utf-8', mode)
+                except UnicodeDecodeError:
+                    dec_path = path.decode('iso-8859-1', mode)
+                enc_path = dec_path.encode(enc, 'replace')
+                if os.path.exists(enc_path):
+                    path = enc_path
+                    break
+            else:
+                parent_path = os.path.dirname(path)
+                try:
+                    candidates = os.listdir(parent_path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    return None, None
+                if len(candidates) != 1:
+                    return None, None
+                path = os.path.join(parent_path, candidates[0])
+                if not os.path.exists(path):
+                    return None, None
+        assert path
+        return archive_path, path
+    return None, None
+
+
 class LocalFileImporterMixin(object):
     """This mixin takes care of interpreting arcane LocalFile information,
        handling incorrectly encoded paths and other artifacts.
@@ -210,62 +339,103 @@ class LocalFileImporterMixin(object):
         return kwargs
 
     def _get_local_file_info(self, resource):
-        archive_id = resource._LocalFile__archivedId
-        repo_path = resource._LocalFile__repository._MaterialLocalRepository__files[archive_id]
-        for archive_path in map(bytes, self.archive_dirs):
-            path = os.path.join(archive_path, repo_path)
-            if any(ord(c) > 127 for c in repo_path):
-                foobar = (('strict', 'iso-8859-1'), ('replace', sys.getfilesystemencoding()), ('replace', 'ascii'))
-                for mode, enc in foobar:
-                    try:
-                        dec_path = path.decode('utf-8', mode)
-                    except UnicodeDecodeError:
-                        dec_path = path.decode('iso-8859-1', mode)
-                    enc_path = dec_path.encode(enc, 'replace')
-                    if os.path.exists(enc_path):
-                        path = enc_path
-                        break
-                else:
-                    parent_path = os.path.dirname(path)
-                    try:
-                        candidates = os.listdir(parent_path)
-                    except OSError as e:
-                        if e.errno != errno.ENOENT:
-                            raise
-                        return None, None, 0, ''
-                    if len(candidates) != 1:
-                        return None, None, 0, ''
-                    path = os.path.join(parent_path, candidates[0])
-                    if not os.path.exists(path):
-                        return None, None, 0, ''
-
-            assert path
-            try:
-                size = 0 if self.avoid_storage_check else os.path.getsize(path)
-                md5 = '' if self.avoid_storage_check else get_file_md5(path)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+        archive_path, path = find_local_file(self.archive_dirs, resource)
+        if path is None:
+            return None, None, 0, ''
+        try:
+            size = 0 if self.avoid_storage_check else os.path.getsize(path)
+            md5 = '' if self.avoid_storage_check else get_file_md5(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None, None, 0, ''
+        rel_path = os.path.relpath(path, archive_path)
+        try:
+            rel_path = rel_path.decode('utf-8')
+        except UnicodeDecodeError:
+            if not self.symlink_target:
                 return None, None, 0, ''
-            rel_path = os.path.relpath(path, archive_path)
+            symlink_name = uuid4()
+            symlink = os.path.join(self.symlink_target, bytes(symlink_name))
+            os.symlink(path, symlink)
+            return self.symlink_backend, symlink_name, size, md5
+        else:
+            return self.storage_backend, rel_path, size, md5
+
+
+class LRUCache(object):
+    """Memoize a function, keeping only the most recently used results.
+
+    All instances are registered in `instances` so their size can be
+    adjusted and their hit rate reported for the whole migration.
+
+    :param func: The function to memoize; its arguments must be hashable
+    :param maxsize: The maximum number of results to keep
+    """
+
+    instances = []
+
+    def __init__(self, func, maxsize):
+        update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        LRUCache.instances.append(self)
+
+    def __call__(self, *args, **kwargs):
+        key = (args, frozenset(kwargs.iteritems())) if kwargs else args
+        with self._lock:
             try:
-                rel_path = rel_path.decode('utf-8')
-            except UnicodeDecodeError:
-                if not self.symlink_target:
-                    return None, None, 0, ''
-                symlink_name = uuid4()
-                symlink = os.path.join(self.symlink_target, bytes(symlink_name))
-                os.symlink(path, symlink)
-                return self.symlink_backend, symlink_name, size, md5
+                rv = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
             else:
-                return self.storage_backend, rel_path, size, md5
+                self.hits += 1
+                self._data[key] = rv
+                return rv
+        rv = self.func(*args, **kwargs)
+        with self._lock:
+            self._data[key] = rv
+            self._trim()
+        return rv
+
+    def _trim(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._trim()
 
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (self.hits / float(total)) if total else 0
 
+
+def lru_memoize(maxsize):
+    """Decorator memoizing a function in a `LRUCache`"""
+    def decorator(f):
+        return LRUCache(f, maxsize)
+    return decorator
+
+
+def set_sanitize_cache_size(maxsize):
+    """Set the number of results kept by each of the cached sanitizers"""
+    for cache in (strict_sanitize_email, sanitize_user_input):
+        cache.resize(maxsize)
+
+
+@lru_memoize(10000)
 def strict_sanitize_email(email, fallback=None):
     return sanitize_email(convert_to_unicode(email).lower(), require_valid=True) or fallback
 
 
-@memoize
+@lru_memoize(10000)
 def sanitize_user_input(string, html=False):
     string = convert_to_unicode(string)
     if not html:
@@ -283,6 +453,72 @@ def strict_now_utc():
     return dt
 
 
+class DisjointSet(object):
+    """A union-find structure with path compression and union by rank.
+
+    Each set has a representative which does not depend on how the sets
+    are linked internally: when merging two sets, the representative of
+    the one merged into is kept.
+    """
+
+    def __init__(self):
+        self._parents = {}
+        self._ranks = {}
+        self._representatives = {}
+        self._sizes = {}
+
+    def __contains__(self, item):
+        return item in self._parents
+
+    def __iter__(self):
+        return iter(self._parents)
+
+    def __len__(self):
+        return len(self._parents)
+
+    def _find_root(self, item):
+        parents = self._parents
+        if item not in parents:
+            parents[item] = item
+            self._ranks[item] = 0
+            self._representatives[item] = item
+            self._sizes[item] = 1
+            return item
+        root = item
+        while parents[root] != root:
+            root = parents[root]
+        while parents[item] != root:
+            parents[item], item = root, parents[item]
+        return root
+
+    def find(self, item):
+        """Get the representative of the set containing `item`"""
+        return self._representatives[self._find_root(item)]
+
+    def size(self, item):
+        """Get the number of items in the set containing `item`"""
+        return self._sizes[self._find_root(item)]
+
+    def union(self, item, target):
+        """Merge the set containing `item` into the one containing `target`.
+
+        :return: ``False`` if both were already in the same set
+        """
+        root = self._find_root(item)
+        target_root = self._find_root(target)
+        if root == target_root:
+            return False
+        representative = self._representatives[target_root]
+        if self._ranks[root] > self._ranks[target_root]:
+            root, target_root = target_root, root
+        self._parents[root] = target_root
+        if self._ranks[root] == self._ranks[target_root]:
+            self._ranks[target_root] += 1
+        self._representatives[target_root] = representative
+        self._sizes[target_root] += self._sizes.pop(root)
+        return True
+
+
 class MigrationStateManager(object):
     _namespaces = {}
     _steps = []
@@ -299,19 +535,26 @@ class MigrationStateManager(object):
     def register_ns(cls, ns):
         cls._namespaces[ns.name] = ns
 
+    @classmethod
+    def serialize_namespaces(cls):
+        return {ns.name: ns.serialize() for ns in cls._namespaces.viewvalues()}
+
+    @classmethod
+    def load_namespaces(cls, data):
+        for name, ns in cls._namespaces.viewitems():
+            ns.load(data['namespaces'][name])
+
     @classmethod
     def save_restore_point(cls, fd):
-        ns_data = {ns.name: ns.serialize() for ns in cls._namespaces.viewvalues()}
         yaml.dump({
-            'namespaces': ns_data,
+            'namespaces': cls.serialize_namespaces(),
             'steps': cls._steps
         }, fd)
 
     @classmethod
     def load_restore_point(cls, data):
         cls._steps = data['steps']
-        for name, ns in cls._namespaces.viewitems():
-            ns.load(data['namespaces'][name])
+        cls.load_namespaces(data)
 
 
 def step_description(description):
@@ -0,0 +1,419 @@
+# This file is part of Indico.
+# Copyright (C) 2002 - 2017 European Organization for Nuclear Research (CERN).
+#
+# Indico is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# Indico is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Indico; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function, unicode_literals
+
+import json
+import os
+import sys
+import time
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import click
+from sqlalchemy import create_engine, func, select
+
+from indico.modules.attachments.models.legacy_mapping import LegacyAttachmentMapping
+from indico.modules.categories.models.categories import Category
+from indico.modules.categories.models.legacy_mapping import LegacyCategoryMapping
+from indico.modules.events.abstracts.models.abstracts import Abstract
+from indico.modules.events.contributions.models.contributions import Contribution
+from indico.modules.events.logs import EventLogEntry
+from indico.modules.events.models.events import Event
+from indico.modules.events.models.legacy_mapping import LegacyEventMapping
+from indico.modules.events.registration.models.legacy_mapping import LegacyRegistrationMapping
+from indico.modules.events.sessions.models.sessions import Session
+from indico.modules.rb.models.reservation_occurrences import ReservationOccurrence
+from indico.modules.rb.models.reservations import RepeatMapping, Reservation
+from indico.util.string import is_legacy_id
+
+from indico_migrate.attachments import get_skip_reason, iter_legacy_attachments
+from indico_migrate.delta import collect_changes, get_last_tid, iter_categories
+from indico_migrate.steps.room_bookings import utc_to_local
+from indico_migrate.util import UnbreakingDB, cformat2, get_storage, partition_keys
+
+
+click.disable_unicode_literals_warning = True
+
+#: The columns linking the migrated rows to their event, by the kind of
+#: legacy object they have been created from
+EVENT_COUNTS = OrderedDict([
+    ('contributions', Contribution.__table__.c.event_id),
+    ('sessions', Session.__table__.c.event_id),
+    ('registrants', LegacyRegistrationMapping.__table__.c.event_id),
+    ('abstracts', Abstract.__table__.c.event_id),
+    ('attachments', LegacyAttachmentMapping.__table__.c.event_id),
+    ('log_entries', EventLogEntry.__table__.c.event_id),
+    ('bookings', Reservation.__table__.c.event_id),
+])
+
+#: The number of events whose rows are counted by a single query
+CHUNK_SIZE = 1000
+
+
+def _open_root(zodb_uri):
+    return UnbreakingDB(get_storage(zodb_uri, read_only=True)).open().root()
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _get_event_id(conf_id, legacy_event_ids):
+    return legacy_event_ids.get(conf_id) if is_legacy_id(conf_id) else int(conf_id)
+
+
+def count_legacy_objects(conf, rb_root=None, archive_dirs=(), symlinks=False):
+    """Count the objects of a legacy conference the migration creates rows for
+
+    The resources the migration skips (links without a URL and, if the
+    `archive_dirs` are given, files which cannot be found) are counted as
+    ``skipped_attachments`` instead of ``attachments``.  The occurrences
+    of the bookings are only counted if the `rb_root` is given.
+    """
+    attachments = skipped_attachments = 0
+    for obj in _iter_attachment_holders(conf):
+        for material, resources in iter_legacy_attachments(obj):
+            for resource in resources:
+                if get_skip_reason(resource, archive_dirs, symlinks) is None:
+                    attachments += 1
+                else:
+                    skipped_attachments += 1
+    amgr = getattr(conf, 'abstractMgr', None)
+    log_handler = getattr(conf, '_logHandler', None)
+    booking_ids = [int(x.id) for x in getattr(conf, '_Conference__roomBookingGuids', []) if x.id is not None]
+    counts = {
+        'contributions': len(conf.contributions),
+        'sessions': len(conf.sessions),
+        # registrants without a random id do not get a legacy mapping
+        'registrants': sum(1 for reg in getattr(conf, '_registrants', {}).itervalues() if hasattr(reg, '_randomId')),
+        'abstracts': len(amgr._abstracts) if amgr is not None else 0,
+        'attachments': attachments,
+        'skipped_attachments': skipped_attachments,
+        'log_entries': (len(log_handler._logLists['emailLog']) + len(log_handler._logLists['actionLog'])
+                        if log_handler is not None else 0),
+        'bookings': len(booking_ids)
+    }
+    if rb_root is not None:
+        counts['occurrences'] = counts['cancelled_occurrences'] = 0
+        reservations = rb_root['Reservations']
+        for resv_id in booking_ids:
+            resv = reservations.get(resv_id)
+            if resv is not None:
+                occurrences, cancelled = count_legacy_occurrences(resv)
+                counts['occurrences'] += occurrences
+                counts['cancelled_occurrences'] += cancelled
+    return counts
+
+
+def count_legacy_occurrences(resv):
+    """Count the occurrences of a legacy booking and how many of them are cancelled
+
+    The dates are taken from the repetition of the booking; the excluded
+    days are cancelled (just like all dates of a cancelled booking).
+    """
+    repetition = RepeatMapping.convert_legacy_repeatability(resv.repeatability)
+    excluded_days = set(getattr(resv, '_excludedDays', []) or [])
+    occurrences = cancelled = 0
+    for start_dt in ReservationOccurrence.iter_start_time(utc_to_local(resv._utcStartDT),
+                                                          utc_to_local(resv._utcEndDT), repetition):
+        occurrences += 1
+        if resv.isCancelled or start_dt.date() in excluded_days:
+            cancelled += 1
+    return occurrences, cancelled
+
+
+def _iter_attachment_holders(conf):
+    yield conf
+    for old_session in conf.sessions.itervalues():
+        yield old_session
+    for old_contrib in conf.contributions.itervalues():
+        yield old_contrib
+        for old_subcontrib in old_contrib._subConts:
+            yield old_subcontrib
+
+
+def _count_rows(conn, event_ids, occurrences=False):
+    counts = {kind: dict(conn.execute(select([col, func.count()]).where(col.in_(event_ids)).group_by(col)))
+              for kind, col in EVENT_COUNTS.iteritems()}
+    if occurrences:
+        res = Reservation.__table__
+        occ = ReservationOccurrence.__table__
+        query = (select([res.c.event_id, func.count()])
+                 .select_from(occ.join(res, occ.c.reservation_id == res.c.id))
+                 .where(res.c.event_id.in_(event_ids))
+                 .group_by(res.c.event_id))
+        counts['occurrences'] = dict(conn.execute(query))
+        counts['cancelled_occurrences'] = dict(conn.execute(query.where(occ.c.is_cancelled)))
+    return counts
+
+
+def _verify_partition(args):
+    settings, part, min_key, max_key, cache = args
+    start = time.time()
+    root = _open_root(settings['zodb_uri'])
+    zodb_conn = root._p_jar
+    rb_root = _open_root(settings['rb_zodb_uri']) if settings['rb_zodb_uri'] else None
+
+    legacy_counts = {}
+    cached = 0
+    for i, (conf_id, conf) in enumerate(root['conferences'].iteritems(min=min_key, max=max_key), 1):
+        counts = cache.get(conf_id)
+        if counts is not None:
+            cached += 1
+        else:
+            counts = count_legacy_objects(conf, rb_root, settings['archive_dirs'], settings['symlinks'])
+        legacy_counts[conf_id] = counts
+        if i % 1000 == 0:
+            zodb_conn.cacheMinimize()
+            if rb_root is not None:
+                rb_root._p_jar.cacheMinimize()
+    zodb_conn.db().close()
+    if rb_root is not None:
+        rb_root._p_jar.db().close()
+
+    engine = create_engine(settings['sqlalchemy_uri'])
+    mismatches = []
+    with engine.connect() as conn:
+        legacy_ids = [conf_id for conf_id in legacy_counts if is_legacy_id(conf_id)]
+        legacy_event_ids = {}
+        mapping = LegacyEventMapping.__table__
+        for chunk in _chunks(legacy_ids):
+            legacy_event_ids.update(conn.execute(select([mapping.c.legacy_event_id, mapping.c.event_id])
+                                                 .where(mapping.c.legacy_event_id.in_(chunk))))
+        event_ids = {conf_id: _get_event_id(conf_id, legacy_event_ids) for conf_id in legacy_counts}
+        existing = set()
+        events = Event.__table__
+        for chunk in _chunks(x for x in event_ids.itervalues() if x is not None):
+            existing.update(x for x, in conn.execute(select([events.c.id]).where(events.c.id.in_(chunk))))
+        for conf_id, event_id in sorted(event_ids.iteritems()):
+            if event_id not in existing:
+                mismatches.append({'event': conf_id, 'event_id': event_id, 'kind': 'event', 'zodb': 1, 'db': 0})
+
+        conf_ids = {event_id: conf_id for conf_id, event_id in event_ids.iteritems() if event_id in existing}
+        for chunk in _chunks(sorted(conf_ids)):
+            counts = _count_rows(conn, chunk, occurrences=(rb_root is not None))
+            for event_id in chunk:
+                conf_id = conf_ids[event_id]
+                for kind, value in sorted(legacy_counts[conf_id].iteritems()):
+                    if kind not in counts:
+                        # e.g. the skipped attachments
+                        continue
+                    actual = counts[kind].get(event_id, 0)
+                    if actual != value:
+                        mismatches.append({'event': conf_id, 'event_id': event_id, 'kind': kind, 'zodb': value,
+                                           'db': actual})
+    engine.dispose()
+    return part, mismatches, legacy_counts, cached, time.time() - start
+
+
+def verify_categories(zodb_uri, sqlalchemy_uri):
+    """Compare the number of events and subcategories of every category"""
+    root = _open_root(zodb_uri)
+    engine = create_engine(sqlalchemy_uri)
+    mismatches = []
+    mapping = LegacyCategoryMapping.__table__
+    categ_table = Category.__table__
+    events = Event.__table__
+    with engine.connect() as conn:
+        legacy_category_ids = dict(conn.execute(select([mapping.c.legacy_category_id, mapping.c.category_id])))
+        categories = {}
+        for categ in iter_categories(root['rootCategory']):
+            categories[categ.id] = (legacy_category_ids.get(categ.id) if is_legacy_id(categ.id)
+                                    else int(categ.id))
+        migrated = set(categories.itervalues())
+        existing = set()
+        # categories which do not exist in the ZODB (i.e. "Lost & Found") are not counted
+        children = Counter()
+        for category_id, parent_id in conn.execute(select([categ_table.c.id, categ_table.c.parent_id])
+                                                   .where(~categ_table.c.is_deleted)):
+            existing.add(category_id)
+            if category_id in migrated:
+                children[parent_id] += 1
+        event_counts = dict(conn.execute(select([events.c.category_id, func.count()])
+                                         .where(~events.c.is_deleted)
+                                         .group_by(events.c.category_id)))
+        for categ in iter_categories(root['rootCategory']):
+            category_id = categories[categ.id]
+            if category_id not in existing:
+                mismatches.append({'category': categ.id, 'category_id': category_id, 'kind': 'category',
+                                   'zodb': 1, 'db': 0})
+                continue
+            expected = {'events': len(categ.conferences), 'subcategories': len(categ.subcategories)}
+            actual = {'events': event_counts.get(category_id, 0), 'subcategories': children[category_id]}
+            for kind, value in sorted(expected.iteritems()):
+                if actual[kind] != value:
+                    mismatches.append({'category': categ.id, 'category_id': category_id, 'kind': kind,
+                                       'zodb': value, 'db': actual[kind]})
+    engine.dispose()
+    root._p_jar.db().close()
+    return mismatches
+
+
+def _load_cache(path, root, rb_tid, options):
+    """Load the cached counts which are still valid.
+
+    The cache contains the id of the last transaction at the time the
+    counts were taken.  The changes committed since are traced back to
+    their conferences (see `collect_changes`), whose counts are dropped.
+    The whole cache is discarded if the room booking ZODB changed, if a
+    change cannot be traced back to its conference or if the counts were
+    taken using different options.
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        cache = json.load(f)
+    if cache.get('options') != options or cache.get('rb_tid') != rb_tid:
+        print(cformat2('%[yellow]Discarding the cache since the options or the room booking ZODB changed'))
+        return {}
+    changes, unattributed = collect_changes(root, cache['tid'])
+    if unattributed:
+        print(cformat2('%[yellow]Discarding the cache since {} changed records could not be traced back to their '
+                       'conference').format(unattributed))
+        return {}
+    counts = cache['counts']
+    for conf_id in changes['conferences']:
+        counts.pop(conf_id, None)
+    return counts
+
+
+def _save_cache(path, tid, rb_tid, options, counts):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'tid': tid, 'rb_tid': rb_tid, 'options': options, 'counts': counts}, f)
+    os.rename(path + '.tmp', path)
+
+
+def _split_cache(cache, ranges):
+    """Split the cached counts by the key ranges they belong to"""
+    min_keys = [min_key for min_key, max_key in ranges]
+    parts = [{} for _ in ranges]
+    for key, counts in cache.iteritems():
+        i = bisect_right(min_keys, key) - 1
+        if i >= 0:
+            parts[i][key] = counts
+    return parts
+
+
+def _format_mismatch(mismatch):
+    if 'event' in mismatch:
+        obj = 'event {} ({})'.format(mismatch['event'], mismatch['event_id'])
+    else:
+        obj = 'category {} ({})'.format(mismatch['category'], mismatch['category_id'])
+    return cformat2('%[red]\u00d7%[reset] {}: %[cyan]{}%[reset] zodb=%[green]{}%[reset] db=%[red!]{}%[reset]').format(
+        obj, mismatch['kind'], mismatch['zodb'], mismatch['db'])
+
+
+def verify(zodb_uri, sqlalchemy_uri, processes, partitions, rb_zodb_uri=None, archive_dirs=(), symlinks=False,
+           cache_file=None, report=None):
+    """Compare the legacy objects in the ZODB with what has been migrated.
+
+    The conferences are split into `partitions` key ranges which are
+    verified in parallel by `processes` worker processes, each of them
+    using its own ZODB and database connection.  The counts taken from
+    the ZODB are saved to `cache_file`, so they only need to be taken
+    again for the conferences that changed since.
+
+    :return: the list of mismatches
+    """
+    options = {'archive_dirs': list(archive_dirs), 'symlinks': symlinks}
+    root = _open_root(zodb_uri)
+    rb_root = _open_root(rb_zodb_uri) if rb_zodb_uri else None
+    # taken first, so anything committed while counting is counted again next time
+    tid = get_last_tid(root)
+    rb_tid = get_last_tid(rb_root) if rb_root is not None else None
+    cache = _load_cache(cache_file, root, rb_tid, options)
+    ranges = partition_keys(root['conferences'], partitions)
+    root._p_jar.db().close()
+    if rb_root is not None:
+        rb_root._p_jar.db().close()
+    print(cformat2('%[cyan]conferences%[reset]: {} partitions').format(len(ranges)))
+    settings = dict(options, zodb_uri=zodb_uri, rb_zodb_uri=rb_zodb_uri, sqlalchemy_uri=sqlalchemy_uri)
+    tasks = [(settings, i, min_key, max_key, part_cache)
+             for i, ((min_key, max_key), part_cache) in enumerate(zip(ranges, _split_cache(cache, ranges)))]
+
+    start = time.time()
+    mismatches = []
+    legacy_counts = {}
+    pool = Pool(processes)
+    try:
+        for part, part_mismatches, part_counts, cached, duration in pool.imap_unordered(_verify_partition, tasks):
+            mismatches += part_mismatches
+            legacy_counts.update(part_counts)
+            print(cformat2('%[green]\u2713%[reset] %[cyan]conferences%[reset] #{}: {} events ({} cached), '
+                           '{} mismatches in {:.02f}s').format(part, len(part_counts), cached, len(part_mismatches),
+                                                                duration))
+    finally:
+        pool.close()
+        pool.join()
+    if cache_file:
+        _save_cache(cache_file, tid, rb_tid, options, legacy_counts)
+    skipped = sum(counts['skipped_attachments'] for counts in legacy_counts.itervalues())
+    if skipped:
+        print(cformat2('%[yellow]{} attachments have been skipped by the migration (missing URL or file)')
+              .format(skipped))
+    mismatches.sort(key=lambda x: (x['event'], x['kind']))
+    category_mismatches = verify_categories(zodb_uri, sqlalchemy_uri)
+    print(cformat2('%[green]\u2713%[reset] %[cyan]categories%[reset]: {} mismatches')
+          .format(len(category_mismatches)))
+    mismatches += category_mismatches
+
+    for mismatch in mismatches:
+        print(_format_mismatch(mismatch))
+        if report:
+            report.write(json.dumps(mismatch) + '\n')
+    color = 'red!' if mismatches else 'green!'
+    print(cformat2('%[{}]{}%[reset] mismatches, {} events checked in %[cyan]{:.02f} seconds%[reset]').format(
+        color, len(mismatches), len(legacy_counts), time.time() - start))
+    return mismatches
+
+
+@click.command()
+@click.argument('sqlalchemy-uri')
+@click.argument('zodb-uri')
+@click.option('--processes', '-j', type=int, default=cpu_count(), help="Number of worker processes")
+@click.option('--partitions', type=int, help="Number of partitions (defaults to 4x the process count)")
+@click.option('--rb-zodb-uri', help="ZODB URI for the room booking database (to verify the booking occurrences)")
+@click.option('--archive-dir', 'archive_dirs', multiple=True,
+              help="The archive directories used by the migration (to skip the files it did not find)")
+@click.option('--symlinked-paths', 'symlinks', is_flag=True,
+              help="Files with a non-UTF8 path have been symlinked by the migration (--symlink-target)")
+@click.option('--cache-file', type=click.Path(dir_okay=False, writable=True),
+              help="Keep the counts taken from the ZODB in this file and reuse them for unchanged conferences")
+@click.option('--report', type=click.File('w'), help="Write the mismatches to this file (one JSON object per line)")
+def cli(sqlalchemy_uri, zodb_uri, processes, partitions, rb_zodb_uri, archive_dirs, symlinks, cache_file, report):
+    """
+    This script verifies a migration from ZODB/Indico 1.2 to PostgreSQL.
+
+    For every event, the number of contributions, sessions, registrants,
+    abstracts, attachments, log entries and room bookings in the ZODB is
+    compared with the number of rows in the database. If the room booking
+    database is given, the number of occurrences of the bookings (and of
+    the cancelled ones) is compared with what their repetition and
+    excluded days result in. For every category, the number of events and
+    subcategories is compared. The exit code is 1 if there are any
+    mismatches.
+    """
+    if verify(zodb_uri, sqlalchemy_uri, processes, partitions or processes * 4, rb_zodb_uri, archive_dirs, symlinks,
+              cache_file, report):
+        sys.exit(1)
+
+
+def main():
+    return cli()
@@ -35,6 +35,8 @@ setup(
     entry_points={
         'console_scripts': [
             'indico-migrate = indico_migrate.cli:main',
+            'indico-migrate-extract = indico_migrate.extract:main',
+            'indico-migrate-verify = indico_migrate.verify:main',
             'indico-html-sanitize = indico_migrate.html:main'
         ]
     },